@@ -0,0 +1,183 @@
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'llm-based-generation'))
+from benchmark_llm import serve
+from benchmarks.synthetic import make_dataset
+from mock_genai_server import add_server_arguments, server_kwargs
+
+BENCHMARKS = ['sgd', 'multiwoz', 'snips_atis', 'topv2']
+
+
+def generator_command(benchmark, data_dir, save_dir, args):
+    """ :return: (command line of the generator, path of the metrics JSON it writes on exit). """
+    if benchmark in ('sgd', 'multiwoz'):
+        script = os.path.join(ROOT, 'llm-based-generation', 'llm-data-gen.py')
+        command = [script, '--data_dir', data_dir, '--save_dir', save_dir, '--dataset_name', benchmark,
+                   '--model', 'mock/model', '--max_concurrency', str(args.max_concurrency), '--no_cache']
+        metrics_name = f'{benchmark}-metrics'
+    elif benchmark == 'snips_atis':
+        script = os.path.join(ROOT, 'grammar-based-generation', 'SeqSNIPS_SeqATIS-data-gen.py')
+        command = [script, '--data_dir', data_dir, '--save_dir', save_dir, '--no_cache']
+        metrics_name = 'SeqSNIPS_SeqATIS-metrics'
+    else:
+        script = os.path.join(ROOT, 'grammar-based-generation', 'SeqTopV2-data-gen.py')
+        command = [script, '--data_dir', data_dir, '--save_dir', save_dir]
+        metrics_name = 'SeqTopV2-metrics'
+    command += ['--workers', str(args.workers), '--metrics_dir', save_dir]
+    python = shlex.split(args.python) if args.python else [sys.executable]
+    return python + command, os.path.join(save_dir, f'{metrics_name}.json')
+
+
+def run_generator(command, log_path):
+    """ Run a generator to completion.
+    :return: (wall seconds, peak RSS in bytes of the generator and its worker processes).
+    """
+    start = time.perf_counter()
+    with open(log_path, 'w') as log:
+        process = subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT)
+        _, status, usage = os.wait4(process.pid, 0)
+    elapsed = time.perf_counter() - start
+    returncode = os.waitstatus_to_exitcode(status)
+    if returncode != 0:
+        raise RuntimeError(f'{" ".join(command)} failed with exit code {returncode}, see {log_path}')
+    scale = 1 if sys.platform == 'darwin' else 1024  # ru_maxrss is in bytes on macOS, in KiB on Linux
+    return elapsed, usage.ru_maxrss * scale
+
+
+def run_benchmark(benchmark, scale, work_dir, args):
+    """ Generate the synthetic input of `benchmark` at `scale` and run its generator `args.repeat` times on it,
+    each time into an empty output directory; the fastest run is kept.
+    """
+    run_dir = os.path.join(work_dir, f'{benchmark}-{scale}x')
+    shutil.rmtree(run_dir, ignore_errors=True)  # a leftover build manifest would skip the whole build
+    data_dir = os.path.join(run_dir, 'raw')
+    num_records = make_dataset(benchmark, data_dir, scale, seed=args.seed)
+    best = None
+    for repeat in range(args.repeat):
+        save_dir = os.path.join(run_dir, f'processed-{repeat}')
+        os.makedirs(save_dir)
+        command, metrics_path = generator_command(benchmark, data_dir, save_dir, args)
+        elapsed, peak_rss = run_generator(command, os.path.join(save_dir, 'generator.log'))
+        if best is None or elapsed < best[0]:
+            with open(metrics_path, 'r') as file:
+                best = elapsed, peak_rss, json.load(file)
+    elapsed, peak_rss, summary = best
+    result = {
+        'benchmark': benchmark,
+        'scale': scale,
+        'records': num_records,
+        'wall_seconds': elapsed,
+        'records_per_second': num_records / elapsed if elapsed > 0 else 0.0,
+        'peak_rss_bytes': max(peak_rss, summary['peak_rss_bytes']),
+        'stages': {name: stage['seconds'] for name, stage in summary['stages'].items()},
+    }
+    print(f"{benchmark} {scale}x: {num_records} records in {elapsed:.2f}s "
+          f"({result['records_per_second']:.0f} records/s), peak RSS {result['peak_rss_bytes'] / 2 ** 20:.0f} MiB")
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline, tolerance=0.2, min_stage_seconds=0.1):
+    """ Compare two results files run by run: a run regressed if its throughput dropped, or its peak RSS or the
+    time of one of its stages (taking at least `min_stage_seconds`) grew, by more than `tolerance`.
+    :return: list of regression messages.
+    """
+    baseline_runs = {(run['benchmark'], run['scale']): run for run in baseline['runs']}
+    regressions = []
+    for run in results['runs']:
+        old = baseline_runs.get((run['benchmark'], run['scale']))
+        if old is None:
+            continue
+        name = f"{run['benchmark']} {run['scale']}x"
+        ratio = run['records_per_second'] / old['records_per_second'] if old['records_per_second'] else 1.0
+        print(f"{name}: {ratio:.2f}x throughput, "
+              f"{run['peak_rss_bytes'] / max(old['peak_rss_bytes'], 1):.2f}x peak RSS")
+        if ratio < 1 - tolerance:
+            regressions.append(f"{name}: {run['records_per_second']:.0f} records/s, was "
+                               f"{old['records_per_second']:.0f}")
+        if run['peak_rss_bytes'] > old['peak_rss_bytes'] * (1 + tolerance):
+            regressions.append(f"{name}: peak RSS {run['peak_rss_bytes'] / 2 ** 20:.0f} MiB, was "
+                               f"{old['peak_rss_bytes'] / 2 ** 20:.0f} MiB")
+        for stage, seconds in run['stages'].items():
+            old_seconds = old['stages'].get(stage)
+            if old_seconds is not None and max(seconds, old_seconds) >= min_stage_seconds \
+                    and seconds > old_seconds * (1 + tolerance):
+                regressions.append(f"{name}: stage {stage} took {seconds:.2f}s, was {old_seconds:.2f}s")
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark every generator on synthetic data of growing size')
+    parser.add_argument("--benchmarks", type=str, nargs='+', default=BENCHMARKS, choices=BENCHMARKS)
+    parser.add_argument("--scales", type=int, nargs='+', default=[1, 10, 100],
+                        help="sizes of the synthetic inputs, as multiples of the base size")
+    parser.add_argument("--repeat", type=int, default=1, help="runs per benchmark and scale, the fastest is kept")
+    parser.add_argument("--workers", type=int, default=1, help="--workers of the generators")
+    parser.add_argument("--max_concurrency", type=int, default=8, help="--max_concurrency of the LLM-based generator")
+    parser.add_argument("--python", type=str, default=None,
+                        help="command that runs the generator scripts (default: this interpreter)")
+    parser.add_argument("--work_dir", type=str, default=None,
+                        help="where to keep the synthetic data and outputs (default: a temporary directory)")
+    parser.add_argument("--output", type=str, default='benchmark-results.json', help="results JSON file")
+    parser.add_argument("--compare", type=str, default=None,
+                        help="results file of a previous commit; exit with status 1 on regressions")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="relative change reported as a regression")
+    add_server_arguments(parser)
+    # the LLM-based benchmarks measure the generator, not the LLM, so the mock server answers quickly by default
+    parser.set_defaults(latency_mean=0.01, latency_std=0.0, seed=0)
+    args = parser.parse_args()
+
+    server_process = None
+    if {'sgd', 'multiwoz'} & set(args.benchmarks):
+        port_queue = multiprocessing.Queue()
+        server_process = multiprocessing.Process(target=serve, args=(server_kwargs(args), port_queue), daemon=True)
+        server_process.start()
+        os.environ['GENAI_API'] = f'http://127.0.0.1:{port_queue.get()}'
+        os.environ.setdefault('GENAI_KEY', 'mock')
+    runs = []
+    try:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            work_dir = args.work_dir or tmp_dir
+            for benchmark in args.benchmarks:
+                for scale in args.scales:
+                    runs.append(run_benchmark(benchmark, scale, work_dir, args))
+    finally:
+        if server_process is not None:
+            server_process.terminate()
+    results = {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'workers': args.workers,
+        'runs': runs,
+    }
+    with open(args.output, 'w') as file:
+        json.dump(results, file, indent=4)
+    print(f'Results written to {args.output}')
+    if args.compare:
+        with open(args.compare, 'r') as file:
+            regressions = compare(results, json.load(file), args.tolerance)
+        for regression in regressions:
+            print(f'REGRESSION {regression}')
+        if regressions:
+            sys.exit(1)
@@ -0,0 +1,228 @@
+import csv
+import json
+import os
+import random
+
+# --- SGD / MultiWOZ dialogue files (read by llm-based-generation/llm-data-gen.py)
+
+SGD_INTENTS = ['FindRestaurants', 'ReserveRestaurant', 'SearchHotel', 'ReserveHotel', 'GetWeather', 'BuyMovieTickets']
+SGD_SLOTS = {'city': ['San Jose', 'Berkeley', 'Paris'], 'date': ['today', 'tomorrow', 'March 3rd'],
+             'time': ['6 pm', '7:30 pm'], 'number_of_seats': ['2', '4'], 'cuisine': ['Italian', 'Thai']}
+MULTIWOZ_SERVICES = {
+    'restaurant': ('find_restaurant', {'restaurant-area': ['centre', 'north', 'south'],
+                                       'restaurant-food': ['italian', 'chinese', 'indian'],
+                                       'restaurant-pricerange': ['cheap', 'moderate', 'expensive']}),
+    'hotel': ('find_hotel', {'hotel-area': ['east', 'west'], 'hotel-stars': ['3', '4', '5'],
+                             'hotel-parking': ['yes', 'no']}),
+    'train': ('find_train', {'train-departure': ['cambridge', 'london kings cross'], 'train-day': ['monday', 'friday'],
+                             'train-leaveat': ['09:15', '17:45']}),
+    'taxi': ('book_taxi', {'taxi-destination': ['the gallery', 'the station'], 'taxi-arriveby': ['12:00', '18:30']}),
+}
+
+
+def make_synthetic_dialogues(data_dir, num_files=4, dialogs_per_file=50, turns_per_dialog=8, seed=0):
+    """ Write SGD-style dialogue files to data_dir/{train,dev,test}. """
+    rnd = random.Random(seed)
+    for split in ['train', 'dev', 'test']:
+        os.makedirs(os.path.join(data_dir, split), exist_ok=True)
+        for file_idx in range(num_files):
+            dialogs = []
+            for dialog_idx in range(dialogs_per_file):
+                turns = []
+                for _ in range(turns_per_dialog):
+                    intent = rnd.choice(SGD_INTENTS)
+                    slot_values = {slot: [rnd.choice(vals)] for slot, vals in rnd.sample(sorted(SGD_SLOTS.items()), 2)}
+                    turns.append({'speaker': 'USER', 'utterance': 'synthetic user turn',
+                                  'frames': [{'state': {'active_intent': intent, 'slot_values': slot_values}}]})
+                    turns.append({'speaker': 'SYSTEM', 'utterance': 'synthetic system turn', 'frames': []})
+                dialogs.append({'dialogue_id': f'{split}_{file_idx}_{dialog_idx}', 'turns': turns})
+            with open(os.path.join(data_dir, split, f'dialogues_{file_idx:03d}.json'), 'w') as file:
+                json.dump(dialogs, file)
+
+
+def make_multiwoz_dialogues(data_dir, num_files=4, dialogs_per_file=50, turns_per_dialog=8, seed=0):
+    """ Write MultiWOZ 2.2-style dialogue files to data_dir/{train,dev,test}: every user turn has one frame per
+    service of the dialogue, the inactive ones with intent NONE, and the slot values accumulate over the dialogue.
+    """
+    rnd = random.Random(seed)
+    for split in ['train', 'dev', 'test']:
+        os.makedirs(os.path.join(data_dir, split), exist_ok=True)
+        for file_idx in range(num_files):
+            dialogs = []
+            for dialog_idx in range(dialogs_per_file):
+                services = rnd.sample(sorted(MULTIWOZ_SERVICES), 2)
+                states = {service: {} for service in services}
+                turns = []
+                for turn_idx in range(turns_per_dialog):
+                    active = rnd.choice(services)
+                    intent, slots = MULTIWOZ_SERVICES[active]
+                    slot = rnd.choice(sorted(slots))
+                    states[active][slot] = [rnd.choice(slots[slot])]
+                    frames = [{'service': service, 'state': {
+                        'active_intent': MULTIWOZ_SERVICES[service][0] if service == active else 'NONE',
+                        'requested_slots': [], 'slot_values': dict(states[service])}} for service in services]
+                    turns.append({'turn_id': str(2 * turn_idx), 'speaker': 'USER',
+                                  'utterance': f'i need a {active} please', 'frames': frames})
+                    turns.append({'turn_id': str(2 * turn_idx + 1), 'speaker': 'SYSTEM',
+                                  'utterance': 'how else can i help?', 'frames': []})
+                dialogs.append({'dialogue_id': f'{split.upper()}{file_idx:03d}{dialog_idx:04d}.json',
+                                'services': services, 'turns': turns})
+            with open(os.path.join(data_dir, split, f'dialogues_{file_idx + 1:03d}.json'), 'w') as file:
+                json.dump(dialogs, file)
+
+
+# --- ATIS / SNIPS slot files (read by grammar-based-generation/SeqSNIPS_SeqATIS-data-gen.py)
+
+SLOT_TEMPLATES = {
+    'ATIS': {
+        'atis_flight': 'show me flights from {fromloc.city_name} to {toloc.city_name}',
+        'atis_airfare': 'what is the cheapest fare from {fromloc.city_name} to {toloc.city_name}',
+        'atis_ground_service': 'what ground transportation is available in {city_name}',
+        'atis_airline': 'which airlines fly to {toloc.city_name} on {depart_date.day_name}',
+        'atis_flight_time': 'what time does flight {flight_number} leave',
+    },
+    'SNIPS': {
+        'PlayMusic': 'play {track} by {artist}',
+        'GetWeather': 'what is the weather in {city} {timeRange}',
+        'BookRestaurant': 'book a table for {party_size_number} at {restaurant_name}',
+        'AddToPlaylist': 'add {entity_name} to my {playlist} playlist',
+        'RateBook': 'rate this book {rating_value} stars',
+        'SearchScreeningEvent': 'find movie times at {location_name}',
+    },
+}
+SLOT_VALUES = {
+    'fromloc.city_name': ['boston', 'san francisco', 'new york'], 'toloc.city_name': ['denver', 'salt lake city'],
+    'city_name': ['atlanta', 'washington'], 'depart_date.day_name': ['monday', 'friday'],
+    'flight_number': ['ua 270', '1291'], 'track': ['yesterday', 'blue in green'], 'artist': ['queen', 'miles davis'],
+    'city': ['paris', 'new delhi'], 'timeRange': ['tomorrow', 'this weekend'], 'party_size_number': ['two', '4'],
+    'restaurant_name': ['the french laundry', 'nopa'], 'entity_name': ['la isla bonita', 'thriller'],
+    'playlist': ['road trip', 'chill'], 'rating_value': ['three', '5'], 'location_name': ['amc theatres', 'the roxie'],
+}
+# the segmenter splits on these; the other joiners leave the sentence to the spaCy dependency parse
+SPLITTABLE_JOINERS = ['and then', 'and also', ',', 'and']
+PARSED_JOINERS = ['while', 'before']
+
+
+def make_clause(template, rnd):
+    tokens, tags = [], []
+    for word in template.split():
+        if word.startswith('{'):
+            slot = word[1:-1]
+            for idx, value_word in enumerate(rnd.choice(SLOT_VALUES[slot]).split()):
+                tokens.append(value_word)
+                tags.append(('B-' if idx == 0 else 'I-') + slot)
+        else:
+            tokens.append(word)
+            tags.append('O')
+    return tokens, tags
+
+
+def make_slot_files(data_dir, examples_per_split=200, parsed_share=0.1, seed=0):
+    """ Write ATIS and SNIPS files to data_dir/{ATIS,SNIPS}/{train,dev,test}.txt: one 'token tag' line per token
+    followed by the '#'-joined intents of the example and an empty line. Sentences have 1 to 3 intents; a
+    `parsed_share` of the multi-intent ones are joined so that only spaCy can segment them.
+    :return: number of examples written.
+    """
+    rnd = random.Random(seed)
+    num_examples = 0
+    for dataset, templates in SLOT_TEMPLATES.items():
+        os.makedirs(os.path.join(data_dir, dataset), exist_ok=True)
+        for split in ['train', 'dev', 'test']:
+            with open(os.path.join(data_dir, dataset, f'{split}.txt'), 'w') as file:
+                for _ in range(examples_per_split):
+                    intents = rnd.sample(sorted(templates), rnd.choice([1, 1, 2, 2, 3]))
+                    joiners = PARSED_JOINERS if rnd.random() < parsed_share else SPLITTABLE_JOINERS
+                    tokens, tags = [], []
+                    for idx, intent in enumerate(intents):
+                        if idx > 0:
+                            joiner = rnd.choice(joiners).split()
+                            tokens.extend(joiner)
+                            tags.extend(['O'] * len(joiner))
+                        clause_tokens, clause_tags = make_clause(templates[intent], rnd)
+                        tokens.extend(clause_tokens)
+                        tags.extend(clause_tags)
+                    for token, tag in zip(tokens, tags):
+                        file.write(f'{token} {tag}\n')
+                    file.write('#'.join(intents) + '\n\n')
+            num_examples += examples_per_split
+    return num_examples
+
+
+# --- TopV2 TSV files (read by grammar-based-generation/SeqTopV2-data-gen.py)
+
+TOP_DOMAINS = ['navigation', 'alarm', 'event', 'messaging', 'music', 'reminder', 'timer', 'weather']
+TOP_SPLITS = ['train', 'eval', 'test']
+TOP_INTENTS = ['GET_WEATHER', 'GET_EVENT', 'GET_ESTIMATED_DURATION', 'CREATE_ALARM', 'GET_LOCATION', 'SEND_MESSAGE',
+               'CREATE_REMINDER', 'GET_INFO_TRAFFIC', 'PLAY_MUSIC']
+TOP_SLOTS = {'LOCATION': ['the office', 'san diego'], 'DATE_TIME': ['tomorrow morning', 'at 5 pm'],
+             'WEATHER_ATTRIBUTE': ['rain', 'sunny'], 'DESTINATION': ['the airport', 'home'],
+             'RECIPIENT': ['mom', 'alex'], 'MUSIC_ARTIST_NAME': ['adele', 'the beatles']}
+
+
+def make_top_parse(rnd, nested=True):
+    """ :return: (utterance words, TOP bracket string) of a random intent with up to 3 slots; with `nested`, one of
+    the slot values may be an intent of its own.
+    """
+    words, parts = [], [f'[IN:{rnd.choice(TOP_INTENTS)}']
+    for slot in rnd.sample(sorted(TOP_SLOTS), rnd.randint(0, 3)):
+        filler = rnd.choice(['for', 'to', 'in'])
+        words.append(filler)
+        parts.append(filler)
+        if nested and rnd.random() < 0.25:
+            nested = False
+            nested_words, nested_parse = make_top_parse(rnd, nested=False)
+            words.extend(nested_words)
+            parts.append(f'[SL:{slot} {nested_parse} ]')
+        else:
+            value = rnd.choice(TOP_SLOTS[slot])
+            words.extend(value.split())
+            parts.append(f'[SL:{slot} {value} ]')
+    parts.append(']')
+    return words, ' '.join(parts)
+
+
+def make_top_files(data_dir, rows_per_file=50, seed=0):
+    """ Write the 24 TopV2 files data_dir/{domain}_{split}.tsv with `rows_per_file` parses each; a quarter of the
+    utterances chain two top-level intents, so an utterance has at most 4 distinct intents.
+    :return: number of rows written.
+    """
+    rnd = random.Random(seed)
+    os.makedirs(data_dir, exist_ok=True)
+    for domain in TOP_DOMAINS:
+        for split in TOP_SPLITS:
+            with open(os.path.join(data_dir, f'{domain}_{split}.tsv'), 'w', newline='') as file:
+                writer = csv.writer(file, delimiter='\t')
+                writer.writerow(['domain', 'utterance', 'semantic_parse'])
+                for _ in range(rows_per_file):
+                    words, parse = make_top_parse(rnd)
+                    if rnd.random() < 0.25:
+                        second_words, second = make_top_parse(rnd)
+                        words, parse = words + ['and'] + second_words, f'{parse} and {second}'
+                    writer.writerow([domain, ' '.join(words), parse])
+    return len(TOP_DOMAINS) * len(TOP_SPLITS) * rows_per_file
+
+
+# --- one entry point per benchmark, with a scale factor
+
+DIALOG_FILES = 2
+DIALOGS_PER_FILE = 25
+TURNS_PER_DIALOG = 8
+SLOT_EXAMPLES_PER_SPLIT = 200
+TOP_ROWS_PER_FILE = 50
+
+
+def make_dataset(benchmark, data_dir, scale=1, seed=0):
+    """ Write the synthetic raw data of `benchmark` ('sgd', 'multiwoz', 'snips_atis' or 'topv2') at `scale` times
+    the base size: more dialogue files for SGD/MultiWOZ, more examples per split for ATIS/SNIPS and more rows per
+    file for TopV2.
+    :return: number of input records (dialogue turns, examples or TSV rows).
+    """
+    if benchmark in ('sgd', 'multiwoz'):
+        make = make_synthetic_dialogues if benchmark == 'sgd' else make_multiwoz_dialogues
+        make(data_dir, DIALOG_FILES * scale, DIALOGS_PER_FILE, TURNS_PER_DIALOG, seed=seed)
+        return 3 * DIALOG_FILES * scale * DIALOGS_PER_FILE * TURNS_PER_DIALOG * 2
+    if benchmark == 'snips_atis':
+        return make_slot_files(data_dir, SLOT_EXAMPLES_PER_SPLIT * scale, seed=seed)
+    if benchmark == 'topv2':
+        return make_top_files(data_dir, TOP_ROWS_PER_FILE * scale, seed=seed)
+    raise ValueError(f'Unknown benchmark {benchmark!r}')
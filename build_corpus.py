@@ -0,0 +1,274 @@
+import argparse
+import importlib.util
+import json
+import os
+import sys
+import threading
+from functools import partial
+from multiprocessing import Pool
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'llm-based-generation'))
+from request_scheduler import TokenBucket
+from utils.dag import DAG, pool_starmap
+from utils.dedup import dedup_files
+from utils.io import OUTPUT_FORMATS, RecordWriter, chunked
+from utils.manifest import BuildManifest
+from utils.metrics import metrics
+
+
+def load_script(relative_path, module_name):
+    """ Import one of the generator scripts (their file names are not valid module names). The module is
+    registered in sys.modules so that its functions can be sent to the worker processes.
+    """
+    spec = importlib.util.spec_from_file_location(module_name, os.path.join(ROOT, relative_path))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[module_name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+llm_gen = load_script('llm-based-generation/llm-data-gen.py', 'llm_data_gen')
+snips_atis_gen = load_script('grammar-based-generation/SeqSNIPS_SeqATIS-data-gen.py', 'seqsnips_seqatis_data_gen')
+topv2_gen = load_script('grammar-based-generation/SeqTopV2-data-gen.py', 'seqtopv2_data_gen')
+
+
+class BuildContext:
+    """ What the stages of all datasets share: the process pool, the LLM client and the global LLM limits. """
+    def __init__(self, args, pool, llm=None) -> None:
+        self.args = args
+        self.pool = pool
+        self.llm = llm
+        # the in-process local model serves one batch at a time
+        self.llm_limiter = threading.BoundedSemaphore(1 if args.backend == 'local' else args.llm_concurrency)
+        # one token bucket for all paraphrase stages, so that --rate_limit and 429 pauses hold across them
+        self.llm_bucket = TokenBucket(args.rate_limit)
+        self.llm_cache_path = None if args.no_cache else os.path.join(args.save_dir, 'llm-cache.sqlite')
+        self.segment_cache_path = None if args.no_cache else os.path.join(args.save_dir, 'segment-cache.sqlite')
+
+
+# --- llm-based datasets: extract -> paraphrase -> reconstruct -> write, per split
+
+def llm_extract(ctx, data_dir, manifest, extract_dir):
+    raw_records = llm_gen.iter_raw_data(data_dir, workers=ctx.args.workers, manifest=manifest,
+                                        extract_dir=extract_dir, pool=ctx.pool)
+    return llm_gen.group_dialog_apis(raw_records)
+
+
+def llm_paraphrase(ctx, journal_path, extracted, *_previous_split):
+    api_str_list, _ = extracted
+    scheduler = llm_gen.make_scheduler(ctx.llm, max_concurrency=ctx.args.llm_concurrency,
+                                       max_batch_size=ctx.args.max_batch_size, concurrency_limiter=ctx.llm_limiter,
+                                       bucket=ctx.llm_bucket)
+    cache = llm_gen.ParaphraseCache(ctx.llm_cache_path) if ctx.llm_cache_path else None
+    try:
+        return llm_gen.generate_llm_paraphrase(api_str_list, journal_path, scheduler, cache=cache)
+    finally:
+        for error_class, retries in scheduler.retries.items():
+            metrics.count(f'llm_retries_{error_class}', retries)
+        if cache is not None:
+            cache.close()
+
+
+def llm_reconstruct(extracted, api_to_str):
+    _, api_str_dialog_map = extracted
+    return llm_gen.reconstruct_data(api_str_dialog_map, api_to_str)
+
+
+def llm_write(ctx, path_prefix, records):
+    llm_gen.write_processed(path_prefix, records, ctx.args.llm_output_format)
+    print(f'{path_prefix}{OUTPUT_FORMATS[ctx.args.llm_output_format]}: {len(records)} examples')
+    return len(records)
+
+
+def add_llm_dataset(dag, ctx, dataset_name, data_dir_root):
+    save_dir = os.path.join(ctx.args.save_dir, dataset_name)
+    os.makedirs(save_dir, exist_ok=True)
+    manifest = BuildManifest(save_dir)  # only used for the per-dialogue-file extraction cache
+    outputs, writes = [], []
+    # with the paraphrase cache, the splits are paraphrased one after the other so that API strings shared between
+    # them are found in the cache instead of being requested again by each split
+    previous_paraphrase = []
+    for split in ['train', 'test', 'dev']:
+        prefix = f'{dataset_name}/{split}'
+        extract = dag.add(f'{prefix}/extract', partial(
+            llm_extract, ctx, os.path.join(data_dir_root, split), manifest,
+            os.path.join(save_dir, f'{dataset_name}-extract', split)))
+        paraphrase = dag.add(f'{prefix}/paraphrase', partial(
+            llm_paraphrase, ctx, os.path.join(save_dir, f'{dataset_name}-llm-{split}.jsonl')),
+            [extract] + previous_paraphrase)
+        if ctx.llm_cache_path is not None:
+            previous_paraphrase = [paraphrase]
+        reconstruct = dag.add(f'{prefix}/reconstruct', llm_reconstruct, [extract, paraphrase])
+        path_prefix = os.path.join(save_dir, f'{dataset_name}-processed-{split}')
+        writes.append(dag.add(f'{prefix}/write', partial(llm_write, ctx, path_prefix), [reconstruct]))
+        outputs.append(path_prefix + OUTPUT_FORMATS[ctx.args.llm_output_format])
+    add_leakage_report(dag, ctx, dataset_name, outputs, writes, save_dir)
+
+
+# --- SeqATIS / SeqSNIPS: read -> segment -> decode -> write, per split
+
+def grammar_read(file_path):
+    return list(snips_atis_gen.iter_examples(file_path))
+
+
+def grammar_segment(ctx, examples):
+    shards = list(chunked(examples, ctx.args.shard_size))
+    tasks = [(shard, ctx.args.spacy_batch_size, 1, ctx.segment_cache_path) for shard in shards]
+    return [clauses for shard_clauses in pool_starmap(ctx.pool, snips_atis_gen.segment_examples, tasks)
+            for clauses in shard_clauses]
+
+
+def grammar_decode(ctx, examples, all_clauses):
+    size = ctx.args.shard_size
+    tasks = [(examples[i:i + size], all_clauses[i:i + size], ctx.args.check_iob)
+             for i in range(0, len(examples), size)]
+    records, num_failed_exs = [], 0
+    for shard_records, num_failed in pool_starmap(ctx.pool, snips_atis_gen.decode_examples, tasks):
+        records.extend(shard_records)
+        num_failed_exs += num_failed
+    return records, num_failed_exs
+
+
+def grammar_write(ctx, path_prefix, decoded):
+    records, num_failed_exs = decoded
+    with RecordWriter(path_prefix, ctx.args.output_format) as writer:
+        writer.write_all(records)
+    print(f'{writer.path}: {writer.count} examples, num_failed_exs: {num_failed_exs}')
+    return writer.count
+
+
+def add_snips_atis(dag, ctx, data_dir):
+    for dataset in ['ATIS', 'SNIPS']:
+        directory = os.path.join(ctx.args.save_dir, f'Seq{dataset}')
+        os.makedirs(directory, exist_ok=True)
+        outputs, writes = [], []
+        for split in ['train', 'dev', 'test']:
+            prefix = f'Seq{dataset}/{split}'
+            read = dag.add(f'{prefix}/read', partial(grammar_read, os.path.join(data_dir, dataset, f'{split}.txt')))
+            segment = dag.add(f'{prefix}/segment', partial(grammar_segment, ctx), [read])
+            decode = dag.add(f'{prefix}/decode', partial(grammar_decode, ctx), [read, segment])
+            writes.append(dag.add(f'{prefix}/write', partial(grammar_write, ctx, os.path.join(directory, split)),
+                                  [decode]))
+            outputs.append(os.path.join(directory, split) + OUTPUT_FORMATS[ctx.args.output_format])
+        add_leakage_report(dag, ctx, f'Seq{dataset}', outputs, writes, directory)
+
+
+# --- SeqTopV2: one streaming convert stage per (domain, split), then the API catalog of all of them
+
+def topv2_convert(ctx, unit, data_dir, save_dir):
+    return pool_starmap(ctx.pool, topv2_gen.curate_unit, [(unit, data_dir, save_dir, ctx.args.output_format)])[0]
+
+
+def topv2_catalog(save_dir, *results):
+    api_catalog = {}
+    for result in results:  # merged in the order of the serial run
+        topv2_gen.merge_catalog(api_catalog, result['catalog'])
+        print(f"{result['save_path']}: {result['num_examples']} examples")
+    with open(os.path.join(save_dir, 'api_spec.json'), 'w+') as file:
+        json.dump(api_catalog, file, indent=4)
+    return len(api_catalog)
+
+
+def add_topv2(dag, ctx, data_dir):
+    save_dir = os.path.join(ctx.args.save_dir, 'SeqTopV2')
+    os.makedirs(save_dir, exist_ok=True)
+    converts = [dag.add(f'SeqTopV2/{domain}_{split}/convert',
+                        partial(topv2_convert, ctx, (domain, split), data_dir, save_dir))
+                for domain in topv2_gen.DOMAINS for split in topv2_gen.SPLITS]
+    dag.add('SeqTopV2/catalog', partial(topv2_catalog, save_dir), converts)
+    outputs = [os.path.join(save_dir, f'{domain}_{split}') + OUTPUT_FORMATS[ctx.args.output_format]
+               for domain in topv2_gen.DOMAINS for split in topv2_gen.SPLITS]
+    add_leakage_report(dag, ctx, 'SeqTopV2', outputs, converts, save_dir)
+
+
+# --- optional near-duplicate / cross-split leakage report of each dataset, once all its splits are written
+
+def leakage_report(ctx, paths, report_path, *_):
+    report, _ = dedup_files(paths, workers=ctx.args.workers, pool=ctx.pool)
+    with open(report_path, 'w') as file:
+        json.dump(report, file, indent=4)
+    print(f"{report_path}: duplicate pairs {report['duplicate_pairs']}, leaked records {report['leaked_records']}")
+    return report['leaked_records']
+
+
+def add_leakage_report(dag, ctx, dataset_name, outputs, writes, save_dir):
+    if ctx.args.leakage_report:
+        dag.add(f'{dataset_name}/leakage', partial(
+            leakage_report, ctx, outputs, os.path.join(save_dir, 'leakage-report.json')), writes)
+
+
+def parse_llm_datasets(values):
+    datasets = []
+    for value in values or []:
+        name, sep, data_dir = value.partition('=')
+        if not sep or not name or not data_dir:
+            raise argparse.ArgumentTypeError(f'--llm_dataset expects NAME=DATA_DIR, got {value!r}')
+        datasets.append((name, data_dir))
+    return datasets
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build the API-BLEND datasets as one graph of stages')
+    parser.add_argument("--save_dir", type=str, required=True)
+    parser.add_argument("--llm_dataset", type=str, action='append', metavar='NAME=DATA_DIR',
+                        help="llm-based dataset to build from SGD / MultiWOZ dialogues, e.g. SeqSGD=data/raw/sgd "
+                             "(repeatable)")
+    parser.add_argument("--snips_atis_dir", type=str, default=None, help="raw ATIS/SNIPS data, see README")
+    parser.add_argument("--topv2_dir", type=str, default=None, help="raw TOPv2_Dataset directory")
+    parser.add_argument("--model", type=str, default=None, help="LLM used for the llm-based datasets")
+    parser.add_argument("--backend", type=str, default='genai', choices=['genai', 'local'])
+    parser.add_argument("--max_batch_tokens", type=int, default=8192,
+                        help="local backend: padded tokens per generation batch")
+    parser.add_argument("--num_threads", type=int, default=None, help="local backend: torch CPU threads")
+    parser.add_argument("--llm_concurrency", type=int, default=8,
+                        help="LLM requests in flight across all datasets and splits")
+    parser.add_argument("--rate_limit", type=float, default=None,
+                        help="maximum GENAI requests per second across all datasets and splits")
+    parser.add_argument("--max_batch_size", type=int, default=10,
+                        help="upper bound for the adaptive number of prompts per GENAI request")
+    parser.add_argument("--no_cache", action="store_true", help="do not use the paraphrase and segmentation caches")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="processes of the shared pool")
+    parser.add_argument("--max_parallel_stages", type=int, default=16, help="stages running at the same time")
+    parser.add_argument("--spacy_batch_size", type=int, default=256, help="sentences per nlp.pipe batch")
+    parser.add_argument("--shard_size", type=int, default=1000, help="ATIS/SNIPS examples per pool task")
+    parser.add_argument("--output_format", type=str, default='json', choices=sorted(OUTPUT_FORMATS),
+                        help="format of the grammar-based outputs")
+    parser.add_argument("--llm_output_format", type=str, default='jsonl', choices=['jsonl', 'jsonl.gz', 'records'],
+                        help="format of the llm-based outputs")
+    parser.add_argument("--leakage_report", action="store_true",
+                        help="write <dataset dir>/leakage-report.json with the near-duplicates within and across the "
+                             "splits of each dataset (see dedup_leakage.py)")
+    parser.add_argument("--check_iob", action="store_true",
+                        help="verify the IOB decoding against the nltk conlltags2tree path")
+    parser.add_argument("--metrics_dir", type=str, default=None,
+                        help="where to write build_corpus-metrics.json/.prom on exit (default: --save_dir)")
+    args = parser.parse_args()
+    try:
+        llm_datasets = parse_llm_datasets(args.llm_dataset)
+    except argparse.ArgumentTypeError as e:
+        parser.error(str(e))
+    if llm_datasets and not args.model:
+        parser.error('--model is required with --llm_dataset')
+    if not (llm_datasets or args.snips_atis_dir or args.topv2_dir):
+        parser.error('nothing to build, give --llm_dataset, --snips_atis_dir and/or --topv2_dir')
+    os.makedirs(args.save_dir, exist_ok=True)
+    metrics.write_on_exit(os.path.join(args.metrics_dir or args.save_dir, 'build_corpus-metrics'))
+
+    llm = None
+    if llm_datasets:
+        llm = llm_gen.make_backend(args.backend, args.model, max_concurrency=args.llm_concurrency,
+                                   max_batch_tokens=args.max_batch_tokens, num_threads=args.num_threads)
+    # the pool is forked before any stage thread starts
+    with Pool(max(1, args.workers)) as pool:
+        ctx = BuildContext(args, pool, llm)
+        dag = DAG()
+        for name, data_dir in llm_datasets:
+            add_llm_dataset(dag, ctx, name, data_dir)
+        if args.snips_atis_dir:
+            add_snips_atis(dag, ctx, args.snips_atis_dir)
+        if args.topv2_dir:
+            add_topv2(dag, ctx, args.topv2_dir)
+        print(f'{len(dag.stages)} stages, {args.workers} worker processes, {args.llm_concurrency} LLM requests in flight')
+        dag.run(max_parallel=args.max_parallel_stages)
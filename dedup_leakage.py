@@ -0,0 +1,41 @@
+import argparse
+import json
+import os
+
+from utils.dedup import MinHashLSH, dedup_files, write_deduplicated
+from utils.metrics import metrics
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Find near-duplicate records within and across the splits of a '
+                                                 'generated dataset, and optionally drop them')
+    parser.add_argument("--inputs", type=str, nargs='+', required=True,
+                        help="output files of one dataset, e.g. data/processed/SeqSNIPS/*.json; the split "
+                             "(train, dev, eval, test) is read from each file name")
+    parser.add_argument("--report", type=str, required=True, help="where to write the JSON report")
+    parser.add_argument("--drop", action="store_true",
+                        help="also write the files without the duplicates and leaked records to --output_dir")
+    parser.add_argument("--output_dir", type=str, default=None, help="directory of the deduplicated files")
+    parser.add_argument("--threshold", type=float, default=90.0,
+                        help="minimal rapidfuzz ratio (0-100) of the normalized inputs of a near-duplicate pair")
+    parser.add_argument("--api_threshold", type=float, default=90.0,
+                        help="minimal ratio of the canonical API sequences, 0 to compare the inputs only")
+    parser.add_argument("--num_perm", type=int, default=64, help="MinHash signature length")
+    parser.add_argument("--bands", type=int, default=16, help="LSH bands, more bands find less similar candidates")
+    parser.add_argument("--workers", type=int, default=1, help="processes computing signatures and scores")
+    parser.add_argument("--metrics_dir", type=str, default=None,
+                        help="where to write dedup-metrics.json/.prom on exit (default: next to --report)")
+    args = parser.parse_args()
+    if args.drop and not args.output_dir:
+        parser.error('--drop needs --output_dir')
+    metrics.write_on_exit(os.path.join(args.metrics_dir or os.path.dirname(os.path.abspath(args.report)),
+                                       'dedup-metrics'))
+
+    report, dropped = dedup_files(args.inputs, args.threshold, args.api_threshold, workers=args.workers,
+                                  lsh=MinHashLSH(args.num_perm, args.bands))
+    with open(args.report, 'w') as file:
+        json.dump(report, file, indent=4)
+    for key in ['records', 'duplicate_pairs', 'leakage_pairs', 'leaked_records', 'dropped_records']:
+        print(f'{key}: {report[key]}')
+    if args.drop:
+        for path in write_deduplicated(report['files'], dropped, args.output_dir):
+            print(f'Wrote {path}')
@@ -0,0 +1,62 @@
+import argparse
+import json
+from collections import Counter
+from multiprocessing import Pool
+
+from utils.io import iter_records
+from utils.scoring import iter_pairs, score_pairs, summarize
+
+
+def iter_predictions(path):
+    """ Stream the predicted records of `path`: a .txt file holds one predicted API sequence per line, any other
+    file is read like the generators' outputs (see utils/io.py).
+    """
+    if not path.endswith('.txt'):
+        yield from iter_records(path)
+        return
+    with open(path, 'r', encoding='utf8') as fr:
+        for line in fr:
+            yield {'prediction': line.rstrip('\n')}
+
+
+def format_scores(name, scores):
+    return (f"{name}: {scores['examples']} examples | API P/R/F1 {scores['api']['precision']:.4f} "
+            f"{scores['api']['recall']:.4f} {scores['api']['f1']:.4f} | slot P/R/F1 {scores['slot']['precision']:.4f} "
+            f"{scores['slot']['recall']:.4f} {scores['slot']['f1']:.4f} | API sequence "
+            f"{scores['api_sequence_accuracy']:.4f} | exact match {scores['exact_match']:.4f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Score API-sequence predictions against the Seq* datasets')
+    parser.add_argument("--gold", type=str, nargs='+', required=True,
+                        help="gold output files written by the generators (any Seq* dataset and output format)")
+    parser.add_argument("--predictions", type=str, nargs='+', required=True,
+                        help="prediction files, one per gold file and in the same example order: records with a "
+                             "--prediction_key field (or output / apis / APIs), or .txt with one sequence per line")
+    parser.add_argument("--prediction_key", type=str, default='prediction',
+                        help="field of a predicted record that holds its API sequence")
+    parser.add_argument("--workers", type=int, default=1, help="processes parsing and scoring the examples")
+    parser.add_argument("--output", type=str, default=None, help="write the scores to this JSON file")
+    args = parser.parse_args()
+    if len(args.gold) != len(args.predictions):
+        parser.error(f'{len(args.gold)} gold files but {len(args.predictions)} prediction files')
+
+    pool = Pool(args.workers) if args.workers > 1 else None
+    report, total = {}, Counter()
+    try:
+        for gold_path, predictions_path in zip(args.gold, args.predictions):
+            pairs = iter_pairs(iter_records(gold_path), iter_predictions(predictions_path), args.prediction_key)
+            counts = score_pairs(pairs, workers=args.workers, pool=pool)
+            total.update(counts)
+            report[gold_path] = summarize(counts)
+            print(format_scores(gold_path, report[gold_path]))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    if len(args.gold) > 1:
+        report['overall'] = summarize(total)
+        print(format_scores('overall', report['overall']))
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=4)
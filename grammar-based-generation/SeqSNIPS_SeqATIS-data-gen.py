@@ -1,33 +1,69 @@
-import os, json, re
+import os, json, re, sys
+import hashlib
+import inspect
+from importlib import metadata
+from functools import partial
+from itertools import islice
+from multiprocessing import Pool
 from tqdm import tqdm
 import argparse
-import spacy
-en = spacy.load('en_core_web_sm')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from utils.io import OUTPUT_FORMATS, RecordWriter, imap_bounded
+from utils.kvstore import KeyValueStore
+from utils.manifest import BuildManifest, code_version
+from utils.metrics import metrics
 
+SPACY_MODEL = 'en_core_web_sm'
+# clause_parse only needs sentence boundaries and the dependency parse (tok2vec + parser)
+SPACY_EXCLUDE = ['tagger', 'attribute_ruler', 'lemmatizer', 'ner', 'senter']
+SPLIT_DELIMITERS = ['and also', 'and then', ',', 'and', 'also']
+FALLBACK_DELIMITERS = [',', 'and then']
+_nlp = None
+_segment_cache = None
 
-def read_file(file_path):
-    """ Read data file of given path.
+
+def get_nlp():
+    """ Load the spaCy pipeline on first use, so runs that never need a dependency parse never load it. """
+    global _nlp
+    if _nlp is None:
+        import spacy
+        _nlp = spacy.load(SPACY_MODEL, exclude=SPACY_EXCLUDE)
+    return _nlp
+
+
+def iter_examples(file_path):
+    """ Stream the examples of a data file line by line.
     :param file_path: path of data file.
-    :return: list of sentence, list of slot and list of intent.
+    :return: generator of (tokens, slot tags, intent) tuples.
     """
-    texts, slots, intents = [], [], []
     text, slot = [], []
     with open(file_path, 'r', encoding="utf8") as fr:
-        for line in fr.readlines():
+        for line in fr:
             items = line.strip().split()
             if len(items) == 1:
-                texts.append(text)
-                slots.append(slot)
                 if "/" not in items[0]:
-                    intents.append(items)
+                    intent = items
                 else:
                     new = items[0].split("/")
-                    intents.append([new[1]])
+                    intent = [new[1]]
+                yield text, slot, intent
                 # clear buffer lists.
                 text, slot = [], []
             elif len(items) == 2:
                 text.append(items[0].strip())
                 slot.append(items[1].strip())
+
+
+def read_file(file_path):
+    """ Read data file of given path.
+    :param file_path: path of data file.
+    :return: list of sentence, list of slot and list of intent.
+    """
+    texts, slots, intents = [], [], []
+    for text, slot, intent in iter_examples(file_path):
+        texts.append(text)
+        slots.append(slot)
+        intents.append(intent)
     return texts, slots, intents
 
 
@@ -39,8 +75,7 @@ def split_string_on_delimiters(string, delimiters, max_splits=None):
     return re.split(pattern, string, maxsplit=max_splits)
 
 
-def clause_parse(text):
-    doc = en(text)
+def clause_chunks(doc):
     seen = set()
     chunks = []
     for sent in doc.sents:
@@ -61,14 +96,146 @@ def clause_parse(text):
     return chunks
 
 
-def parse_IOB(tokens, tags):
-    from nltk import pos_tag
+def clause_parse(text):
+    return clause_chunks(get_nlp()(text))
+
+
+def delimiter_clauses(sentence, num_intents):
+    """ Split a sentence into one clause per intent with the delimiter rules.
+    :return: list of clauses, or None if the rules fail and the dependency parse is needed.
+    """
+    if num_intents == 1:
+        return [sentence]
+    clauses = split_string_on_delimiters(sentence, SPLIT_DELIMITERS, max_splits=num_intents)
+    if len(clauses) != num_intents:
+        clauses = split_string_on_delimiters(sentence, FALLBACK_DELIMITERS, max_splits=num_intents)
+    if len(clauses) != num_intents:
+        return None
+    return clauses
+
+
+def parsed_clauses(chunks, num_intents):
+    """ Turn the clause_parse chunks of a sentence into clauses, merging them towards one clause per intent. """
+    clauses = [clause for _, clause in chunks]
+    if len(clauses) != num_intents:
+        new_clauses = []
+        for clause in clauses:
+            if len(new_clauses) == 0:
+                new_clauses.append(clause)
+            elif new_clauses[-1].strip().endswith('and and'):
+                new_clauses[-1] = new_clauses[-1].replace('and and', 'and').strip() + ' '+ clause
+            else:
+                new_clauses.append(clause)
+        clauses = new_clauses
+    if len(clauses) > num_intents:
+        new_clauses = []
+        for c in clauses:
+            if len(new_clauses) > 0:
+                if len(new_clauses[-1].split(' ')) < 3:
+                    new_clauses[-1] += ' '+ c
+                    continue
+                elif len(c.split(' ')) < 5:
+                    new_clauses[-1] += ' ' + c
+                    continue
+            new_clauses.append(c)
+        clauses = new_clauses
+    return clauses
+
+
+def package_version(name):
+    try:
+        return metadata.version(name)
+    except metadata.PackageNotFoundError:
+        return None
+
+
+class SegmentationCache(KeyValueStore):
+    """ Segmentation results of the sentences that need a dependency parse, in an in-memory LRU in front of an
+    on-disk (SQLite) store shared across splits and runs.
+    Entries are keyed by a hash of the sentence, the intent count and a fingerprint of the segmentation setup
+    (spaCy model and version, delimiter lists and the source of the segmentation functions), so changing any of
+    them invalidates the cache.
+    """
+    def __init__(self, db_path, lru_size=100000) -> None:
+        super().__init__(db_path, 'clauses', 'clauses', lru_size=lru_size)
+        self.fingerprint = self.segmentation_fingerprint()
+
+    @staticmethod
+    def encode(clauses):
+        return json.dumps(clauses)
+
+    @staticmethod
+    def decode(text):
+        return json.loads(text)
+
+    @staticmethod
+    def segmentation_fingerprint():
+        functions = [split_string_on_delimiters, delimiter_clauses, clause_chunks, parsed_clauses]
+        payload = json.dumps([SPACY_MODEL, package_version(SPACY_MODEL), package_version('spacy'), SPACY_EXCLUDE,
+                              SPLIT_DELIMITERS, FALLBACK_DELIMITERS, [inspect.getsource(f) for f in functions]])
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def make_key(self, sentence, num_intents):
+        payload = json.dumps([self.fingerprint, sentence, num_intents])
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def get_many(self, keys):
+        """ :return: dict of key -> cached clauses for the keys present in the cache. """
+        found = super().get_many(keys)
+        metrics.count('segment_cache_hits', len(found))
+        metrics.count('segment_cache_misses', len(keys) - len(found))
+        return found
+
+
+def get_segment_cache(cache_path):
+    """ Open the segmentation cache once per process (worker processes open their own connection). """
+    global _segment_cache
+    if cache_path is None:
+        return None
+    if _segment_cache is None or _segment_cache.db_path != cache_path:
+        _segment_cache = SegmentationCache(cache_path)
+    return _segment_cache
+
+
+def segment_sentences(sentences, num_intents, batch_size=256, n_process=1, cache=None):
+    """ Split every sentence into clauses in two passes: first the delimiter rules, then one batched
+    `nlp.pipe` over the distinct sentences the rules could not split and that are not in the `cache`.
+    spaCy is only loaded for the second pass, so it is skipped entirely when every lookup hits.
+    :return: list of clause lists, aligned with `sentences`.
+    """
+    all_clauses = [delimiter_clauses(sentence, n) for sentence, n in zip(sentences, num_intents)]
+    pending = {}  # (sentence, intent count) -> indices of the sentences the rules could not split
+    for i, clauses in enumerate(all_clauses):
+        if clauses is None:
+            pending.setdefault((sentences[i], num_intents[i]), []).append(i)
+    if pending and cache is not None:
+        keys = {item: cache.make_key(*item) for item in pending}
+        found = cache.get_many(list(keys.values()))
+        for item in list(pending):
+            if keys[item] in found:
+                for i in pending.pop(item):
+                    all_clauses[i] = found[keys[item]]
+    if pending:
+        items = list(pending)
+        with metrics.stage('clause_parse', items=len(items)):
+            docs = get_nlp().pipe((sentence for sentence, _ in items), batch_size=batch_size, n_process=n_process)
+            for item, doc in zip(items, docs):
+                clauses = parsed_clauses(clause_chunks(doc), item[1])
+                for i in pending[item]:
+                    all_clauses[i] = clauses
+        if cache is not None:
+            cache.put_many((keys[item], all_clauses[pending[item][0]]) for item in items)
+    return all_clauses
+
+
+def parse_IOB_nltk(tokens, tags):
+    """ Reference IOB decoder through nltk's conlltags2tree, used by --check_iob. The tree only needs a POS tag
+    per token to build its leaves, so a placeholder tag is used instead of running a POS tagger.
+    """
     from nltk.tree import Tree
     from nltk.chunk import conlltags2tree
-    # tag each token with pos
-    pos_tags = [pos for token, pos in pos_tag(tokens)] #nltk.download('averaged_perceptron_tagger')
     # convert the BIO / IOB tags to tree
-    conlltags = [(token, pos, tg) for token, pos, tg in zip(tokens, pos_tags, tags)]
+    conlltags = [(token, 'NN', tg) for token, tg in zip(tokens, tags)]
     ne_tree = conlltags2tree(conlltags)  # parse the tree to get our original text
     original_text = []
     for subtree in ne_tree:
@@ -80,93 +247,227 @@ def parse_IOB(tokens, tags):
     return original_text
 
 
-def create_dataset(data_dir, save_dir):
-    for dataset in ['ATIS', 'SNIPS']:
-        print(dataset)
-        num_failed_exs = 0
-        for split in ['train.txt', 'dev.txt', 'test.txt']:
-            print(split)
-            fpath = data_dir + f'/{dataset}/{split}'
-            raw_data = []
-            texts, slots, intents = read_file(fpath)
-            for idx in tqdm(range(len(texts))):
-                sentence = ' '.join(texts[idx]).strip()
-                all_intents = intents[idx][0].split('#')
-                if len(all_intents) == 1:
-                    clauses = [sentence]
+def decode_iob_batch(token_seqs, tag_seqs):
+    """ Decode the labelled spans of many BIO / IOB sequences in one pass over their tags, following the
+    (non-strict) conlltags2tree rules: B-X opens a span, I-X extends the preceding X span or else opens one,
+    O closes the span. No POS tags or trees are built.
+    :return: list of [(span text, label), ...], one per sequence.
+    """
+    all_spans = []
+    for tokens, tags in zip(token_seqs, tag_seqs):
+        spans = []
+        label = None  # label of the span the previous token belongs to, None after an O
+        for token, tag in zip(tokens, tags):
+            if tag.startswith('B-') or (tag.startswith('I-') and tag[2:] != label):
+                label = tag[2:]
+                spans.append((label, [token]))
+            elif tag.startswith('I-'):
+                spans[-1][1].append(token)
+            elif tag == 'O':
+                label = None
+            else:
+                raise ValueError(f'Bad conll tag {tag!r}')
+        all_spans.append([(' '.join(span_tokens), span_label) for span_label, span_tokens in spans])
+    return all_spans
+
+
+def parse_IOB(tokens, tags):
+    return decode_iob_batch([tokens], [tags])[0]
+
+
+def check_iob_equivalence(token_seqs, tag_seqs, decoded):
+    """ Compare decoded spans against the nltk reference decoder, raising on the first mismatch. """
+    for tokens, tags, spans in zip(token_seqs, tag_seqs, decoded):
+        expected = parse_IOB_nltk(tokens, tags)
+        if spans != expected:
+            raise AssertionError(f'IOB decoders disagree on {list(zip(tokens, tags))}: {spans} != {expected}')
+
+
+def split_clause_tags(tokens, tags, clauses):
+    """ Give each clause its share of the sentence's tokens and IOB tags. """
+    start = 0
+    for clause in clauses:
+        num_words = len(clause.split(' '))
+        yield tokens[start:start+num_words], tags[start:start+num_words]
+        start += num_words
+
+
+def build_apis(clause_params, all_intents):
+    apis = []
+    for i, params in enumerate(clause_params):
+        params_dic = {}
+        for (val, name) in params:
+            if name not in params_dic:
+                params_dic[name] = []
+            params_dic[name].append(val)
+        apis.append(
+            {
+                'API': all_intents[i],
+                'Parameters': params_dic
+            }
+        )
+    return apis
+
+
+def example_sentence(example):
+    tokens, _, _ = example
+    return ' '.join(tokens).strip()
+
+
+def example_intents(example):
+    _, _, intent = example
+    return intent[0].split('#')
+
+
+def segment_examples(examples, spacy_batch_size=256, spacy_processes=1, cache_path=None):
+    """ Split the sentence of each (tokens, IOB tags, intent label) example into one clause per intent.
+    :return: list of clause lists, aligned with `examples`.
+    """
+    sentences = [example_sentence(example) for example in examples]
+    return segment_sentences(sentences, [len(example_intents(example)) for example in examples],
+                             batch_size=spacy_batch_size, n_process=spacy_processes,
+                             cache=get_segment_cache(cache_path))
+
+
+def decode_examples(examples, all_clauses, check_iob=False):
+    """ Decode the slot values of every clause and build the output records.
+    :return: list of output records and number of examples whose clauses do not match their intents.
+    """
+    clause_tokens, clause_tags = [], []
+    for (tokens, tags, _), clauses in zip(examples, all_clauses):
+        for tokens, tags in split_clause_tags(tokens, tags, clauses):
+            clause_tokens.append(tokens)
+            clause_tags.append(tags)
+    with metrics.stage('iob_decode', items=len(clause_tags)):
+        clause_params = decode_iob_batch(clause_tokens, clause_tags)
+    if check_iob:
+        check_iob_equivalence(clause_tokens, clause_tags, clause_params)
+    records, num_failed_exs, start = [], 0, 0
+    for example, clauses in zip(examples, all_clauses):
+        all_intents = example_intents(example)
+        num_clauses = len(clauses)
+        if num_clauses != len(all_intents):
+            num_failed_exs += 1
+        apis = build_apis(clause_params[start:start+num_clauses], all_intents)
+        start += num_clauses
+        records.append({
+            'text': example_sentence(example),
+            'APIs': apis,
+        })
+    return records, num_failed_exs
+
+
+def process_examples(examples, spacy_batch_size=256, spacy_processes=1, check_iob=False, cache_path=None):
+    """ Segment and decode a list of (tokens, IOB tags, intent label) examples.
+    :return: list of output records, number of examples whose clauses do not match their intents, and the
+    metrics collected while processing.
+    """
+    metrics_before = metrics.snapshot()
+    all_clauses = segment_examples(examples, spacy_batch_size, spacy_processes, cache_path)
+    records, num_failed_exs = decode_examples(examples, all_clauses, check_iob)
+    return records, num_failed_exs, metrics.delta(metrics_before)
+
+
+def read_shards(file_path, shard_size):
+    """ Stream the examples of a data file in shards of `shard_size`, timing the reads. """
+    examples = iter_examples(file_path)
+    while True:
+        with metrics.stage('read') as stage:
+            shard = list(islice(examples, shard_size))
+            stage['items'] = len(shard)
+        if not shard:
+            return
+        yield shard
+
+
+def create_dataset(data_dir, save_dir, spacy_batch_size=256, spacy_processes=1, check_iob=False, workers=1,
+                   shard_size=1000, output_format='json', cache_path=None, force=False):
+    """ Each split is streamed in shards of `shard_size` examples and the records of a shard are written as soon as
+    it is processed, so memory stays flat on large corpora. With `workers` > 1 the shards are processed by a pool
+    of worker processes (each loading spaCy once) and written back in order, giving the same files as one process.
+    Segmentations that needed spaCy are memoized in the SQLite file `cache_path` across splits and runs.
+    Splits whose input file, code and segmentation setup did not change since the last run (see
+    utils/manifest.py) are skipped; `force` rebuilds everything.
+    """
+    pool = Pool(workers) if workers > 1 else None
+    process_shard = partial(process_examples, spacy_batch_size=spacy_batch_size, check_iob=check_iob,
+                            cache_path=cache_path)
+    manifest = BuildManifest(save_dir, force=force)
+    code = code_version(os.path.abspath(__file__), inspect.getsource(RecordWriter))
+    params = {'output_format': output_format, 'segmentation': SegmentationCache.segmentation_fingerprint()}
+    try:
+        for dataset in ['ATIS', 'SNIPS']:
+            print(dataset)
+            num_failed_exs = 0
+            for split in ['train.txt', 'dev.txt', 'test.txt']:
+                print(split)
+                fpath = data_dir + f'/{dataset}/{split}'
+                output = f"Seq{dataset}/{split.replace('.txt', '')}"
+                inputs = manifest.input_hashes([fpath])
+                if manifest.is_fresh(output, inputs, code, params):
+                    result = manifest.result(output)
+                    num_failed_exs += result['num_failed']
+                    print('Up to date, number of examples: ', result['num_examples'])
+                    print('num_failed_exs: ', num_failed_exs)
+                    print('*'*20)
+                    continue
+                shards = read_shards(fpath, shard_size)
+                if pool is None:
+                    results = (process_examples(shard, spacy_batch_size, spacy_processes, check_iob, cache_path)
+                               for shard in shards)
                 else:
-                    clauses = split_string_on_delimiters(sentence, ['and also', 'and then', ',', 'and', 'also'], max_splits=len(all_intents))
-                    if len(clauses) != len(all_intents):
-                        clauses = split_string_on_delimiters(sentence, [',', 'and then'], max_splits=len(all_intents))
-                    if len(clauses) != len(all_intents):
-                        if len(clauses) != len(all_intents):
-                            clauses = clause_parse(sentence)
-                        if len(clauses) != len(all_intents):
-                            new_clauses = []
-                            for idx, c in enumerate(clauses):
-                                id, clause = c
-                                if len(new_clauses) == 0:
-                                    new_clauses.append(clause)
-                                elif new_clauses[-1].strip().endswith('and and'):
-                                    new_clauses[-1] = new_clauses[-1].replace('and and', 'and').strip() + ' '+ clause
-                                else:
-                                    new_clauses.append(clause)
-                            clauses = new_clauses
-                if len(clauses) > len(all_intents):
-                    new_clauses = []
-                    for c in clauses:
-                        if len(new_clauses) > 0:
-                            if len(new_clauses[-1].split(' ')) < 3:
-                                new_clauses[-1] += ' '+ c
-                                continue
-                            elif len(c.split(' ')) < 5:
-                                new_clauses[-1] += ' ' + c
-                                continue
-                        new_clauses.append(c)
-                    clauses = new_clauses
-                start = 0
-                apis = []
-                for i in range(len(clauses)):
-                    if type(clauses[i]) == tuple:
-                        num, clause = clauses[i]
-                    else:
-                        clause = clauses[i]
-                    num_words = len(clause.split(' '))
-                    slots_arr = slots[idx][start:start+num_words]
-                    tokens = texts[idx][start:start+num_words]
-                    params = parse_IOB(tokens, slots_arr)
-                    start += num_words
-                    params_dic = {}
-                    for (val, name) in params:
-                        if name not in params_dic:
-                            params_dic[name] = []
-                        params_dic[name].append(val)
-                    apis.append(
-                        {
-                            'API': all_intents[i],
-                            'Parameters': params_dic
-                        }
-                    )
-                raw_data.append({
-                    'text': sentence,
-                    'APIs': apis,
-                })
-            directory = f"{save_dir}/Seq{dataset}"
-            if not os.path.exists(directory):
-                os.makedirs(directory)
-            out_fname = f"{directory}/{split.replace('.txt', '')}.json"
-            with open(out_fname, 'w') as file:
-                json.dump(raw_data, file, indent=4)
-            print('Number of examples: ', len(raw_data))
-            print('num_failed_exs: ', num_failed_exs)
-            print('*'*20)
-        print('-'*50)
+                    results = imap_bounded(pool, process_shard, shards, window=2 * workers)
+                directory = f"{save_dir}/Seq{dataset}"
+                if not os.path.exists(directory):
+                    os.makedirs(directory)
+                split_failed = 0
+                with RecordWriter(f"{directory}/{split.replace('.txt', '')}", output_format) as writer:
+                    for records, num_failed, shard_metrics in tqdm(results, unit='shard'):
+                        if pool is not None:
+                            metrics.merge(shard_metrics)
+                        split_failed += num_failed
+                        with metrics.stage('write', items=len(records)):
+                            writer.write_all(records)
+                num_failed_exs += split_failed
+                manifest.record(output, inputs, code, params, [writer.path],
+                                {'num_examples': writer.count, 'num_failed': split_failed})
+                if check_iob:
+                    print('IOB decoding matches nltk on all clauses')
+                print('Number of examples: ', writer.count)
+                print('num_failed_exs: ', num_failed_exs)
+                print('*'*20)
+            print('-'*50)
+    finally:
+        if pool is not None:
+            pool.terminate()  # every shard is written, or one failed and the others are not needed
+            pool.join()
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument("--data_dir", type=str)
     parser.add_argument("--save_dir", type=str)
+    parser.add_argument("--metrics_dir", type=str, default=None,
+                        help="where to write SeqSNIPS_SeqATIS-metrics.json/.prom on exit (default: --save_dir)")
+    parser.add_argument("--spacy_batch_size", type=int, default=256, help="sentences per nlp.pipe batch")
+    parser.add_argument("--spacy_processes", type=int, default=1, help="processes used by nlp.pipe")
+    parser.add_argument("--workers", type=int, default=1, help="worker processes, each handling shards of examples")
+    parser.add_argument("--shard_size", type=int, default=1000, help="examples read, processed and written at a time")
+    parser.add_argument("--output_format", type=str, default='json', choices=sorted(OUTPUT_FORMATS),
+                        help="json array (as before), one record per line (optionally gzip-compressed) or a "
+                             "memory-mapped .records file with an offset index for random access")
+    parser.add_argument("--cache_path", type=str, default=None,
+                        help="SQLite segmentation cache (default: <save_dir>/segment-cache.sqlite)")
+    parser.add_argument("--no_cache", action="store_true", help="do not read or write the segmentation cache")
+    parser.add_argument("--check_iob", action="store_true",
+                        help="verify the IOB decoding against the nltk conlltags2tree path")
+    parser.add_argument("--force", action="store_true",
+                        help="rebuild every split, even those the build manifest marks as up to date")
     args = parser.parse_args()
+    metrics.write_on_exit(os.path.join(args.metrics_dir or args.save_dir, 'SeqSNIPS_SeqATIS-metrics'))
     os.makedirs(args.save_dir, exist_ok=True)
-    create_dataset(args.data_dir, args.save_dir)
\ No newline at end of file
+    cache_path = None if args.no_cache else (args.cache_path or os.path.join(args.save_dir, 'segment-cache.sqlite'))
+    create_dataset(args.data_dir, args.save_dir, spacy_batch_size=args.spacy_batch_size,
+                   spacy_processes=args.spacy_processes, check_iob=args.check_iob,
+                   workers=args.workers, shard_size=args.shard_size,
+                   output_format=args.output_format, cache_path=cache_path, force=args.force)
\ No newline at end of file
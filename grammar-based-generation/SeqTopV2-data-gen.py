@@ -2,201 +2,225 @@ import json
 import csv
 import re
 import argparse
+import inspect
 import os
+import sys
+import time
+from functools import partial
+from multiprocessing import Pool
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from utils.io import OUTPUT_FORMATS, RecordWriter
+from utils.manifest import BuildManifest, code_version
+from utils.metrics import metrics
 
-def get_ontologies(parsed_string):
-    ontologies = {}
-    text = re.sub(r"\s*\[\s*", " [ ", parsed_string)
-    text = re.sub(r"\s*\]\s*", " ] ", text)
-    left_sq_brackets = []
-    intents = []
-    for token in text.strip().split():
-        if token == "[":
-            if len(left_sq_brackets) > 0:
-                left_sq_brackets[-1] += 1
-        elif token == "]":
-            left_sq_brackets[-1] -= 1
-            if left_sq_brackets[-1] == 0:
-                left_sq_brackets.pop()
-                intents.pop()
-        elif token.startswith("IN:"):
-            if len(left_sq_brackets) > 0:
-                left_sq_brackets[-1] -= 1
-            left_sq_brackets.append(1)
-            intent = token[len("IN:"):]
-            intents.append(intent)
-            ontologies[intent] = ontologies[intent] if intent in ontologies else []
-        elif token.startswith("SL:"):
-            slot = token[len("SL:"):]
-            if slot not in ontologies[intents[-1]]:
-                ontologies[intents[-1]].append(slot)
-    return ontologies
-
-
-def parse_string_to_tree(input_string):
-    tokens = input_string.split()
-    stack = []
-    for token in tokens:
-        if token.startswith('['):
-            intent = token[1:].split(':')[1]
-            node = {'intent': intent, 'slots': []}
-            if stack:
-                stack[-1]['slots'].append(node)
+
+TOP_TOKEN = re.compile(r'\[([^\s\[\]]*)|\]')
+
+
+def parse_top(input_string):
+    """ Parse a TOP bracket string in one pass over its bracket tokens.
+    An intent node is {'intent', 'start', 'slots'} and a slot node is {'slot', 'start', 'value', 'intents'}, where
+    `start` is the offset of the node's '['. A slot's value is its source text, or the name of its first nested
+    intent if it has one.
+    :return: list of all intent nodes in source order.
+    """
+    intents, stack = [], []
+    for match in TOP_TOKEN.finditer(input_string):
+        label = match.group(1)
+        if label is None:  # ']'
+            node = stack.pop()
+            if 'slot' in node:
+                if node['intents']:
+                    node['value'] = node['intents'][0]['intent']
+                else:
+                    node['value'] = input_string[node.pop('text_start'):match.start()].strip()
+        elif label.startswith('IN:'):
+            node = {'intent': label[len('IN:'):], 'start': match.start(), 'slots': []}
+            intents.append(node)
+            if stack and 'slot' in stack[-1]:
+                stack[-1]['intents'].append(node)
             stack.append(node)
-        elif token.startswith('SL:'):
-            slot = token[3:]
-            if stack:
-                stack[-1]['slots'].append(slot)
-        elif token == ']':
-            if len(stack) > 1:
-                top = stack.pop()
-                if len(stack) > 0:
-                    stack[-1]['slots'].append(top)
-    return stack[0]
-
-
-def extract_nested_slots(input_string):
-    matches = []
-    while True:
-        match = re.search(r'\[SL:([^][]+)\s+([^][]+)\]', input_string)
-        if match:
-            slot_name = match.group(1)
-            slot_text = match.group(2)
-            matches.append((slot_name, slot_text.strip()))
-            input_string = input_string[:match.start()] + input_string[match.end():]
         else:
-            break
-    return matches
-
-
-def extract_slots(input_string):
-    matches = []
-    stack = []
-    for i, char in enumerate(input_string):
-        if char == '[':
-            stack.append(i)
-        elif char == ']':
-            if stack:
-                start = stack.pop()
-                if input_string[start:start + 4] == '[SL:':
-                    slot_info = input_string[start:i + 1]
-                    matches.append(slot_info)
-
-    return matches
-
-def curate_seqtopv2(data_dir, save_dir):
+            node = {'slot': label[len('SL:'):], 'start': match.start(), 'value': '', 'intents': [],
+                    'text_start': match.end()}
+            owner = next((parent for parent in reversed(stack) if 'intent' in parent), None)
+            if owner is not None:
+                owner['slots'].append(node)
+            stack.append(node)
+    return intents
+
+
+def utterance_apis(input_string):
+    """ Collect the slots of every intent of a TOP parse; an intent occurring several times gets the union of its
+    slots, and a repeated slot keeps its first value.
+    :return: dict of intent -> (offset of its first occurrence, dict of slot -> value), in source order.
+    """
+    apis = {}
+    for node in parse_top(input_string):
+        _, slots = apis.setdefault(node['intent'], (node['start'], {}))
+        for slot in node['slots']:
+            slots.setdefault(slot['slot'], slot['value'])
+    return apis
+
+
+def iter_tsv_rows(tsv_file_path):
+    """ Stream the (utterance, TOP parse) pairs of a TopV2 TSV file, skipping its header row. """
+    with open(tsv_file_path, "r", newline="") as file:
+        # Create a CSV reader with tab as the delimiter
+        reader = csv.reader(file, delimiter="\t")
+        next(reader, None)
+        for row in reader:
+            yield row[1], row[2]
+
+
+DOMAINS = ['navigation', 'alarm', 'event', 'messaging', 'music', 'reminder', 'timer', 'weather']
+SPLITS = ['train', 'eval', 'test']
+
+
+def curate_unit(unit, data_dir, save_dir, output_format='json'):
+    """ Convert the TSV file of one (domain, split) unit and write its output file.
+    The catalog is returned in partial form, so that units can run in any process and still be merged into the
+    catalog a serial run builds (see `merge_catalog`).
+    :return: dict with the TSV and output paths, the number of written examples, the histogram of APIs per example, the
+    partial catalog {intent: (slots of its first sighting, slots of its later sightings)} and the unit's metrics.
+    """
+    metrics_before = metrics.snapshot()
+    domain, split = unit
+    num_intents = {"1": 0, "2": 0, "3": 0, '4': 0, '5': 0}
+    catalog = {}
+    tsv_file_path = os.path.join(data_dir, f'{domain}_{split}.tsv')
+    writer = RecordWriter(os.path.join(save_dir, f"{domain}_{split}"), output_format)
+    parse_seconds, write_seconds, num_rows = 0.0, 0.0, 0
+    # Stream the TSV file and write each example as soon as it is parsed
+    for question, input_string in iter_tsv_rows(tsv_file_path):
+        num_rows += 1
+        parse_start = time.perf_counter()
+        apis = utterance_apis(input_string)
+        parse_seconds += time.perf_counter() - parse_start
+        apis_seq = []
+
+        for intent, (position, api_slots) in apis.items():
+            if 'UNSUPPORTED_' in intent:
+                continue
+            api_slots_arr = [f'{slot} = "{val}"' for slot, val in api_slots.items()]
+            api = f'{intent}({", ".join(api_slots_arr)})'
+            apis_seq.append((api, position))
+            if intent not in catalog:
+                catalog[intent] = (list(api_slots), [])
+            else:
+                for slot_name in api_slots:
+                    if slot_name not in catalog[intent][1]:
+                        catalog[intent][1].append(slot_name)
+
+        # the API of the last (innermost) intent in the string comes first
+        if len(apis_seq) > 0:
+            ordered_seq = sorted(apis_seq, key=lambda tup: tup[1], reverse=True)
+            only_apis = []
+            for api in ordered_seq:
+                only_apis.append(api[0])
+            write_start = time.perf_counter()
+            writer.write(
+                {
+                    "input": question,
+                    'apis': only_apis,
+                }
+            )
+            write_seconds += time.perf_counter() - write_start
+            num_intents[str(len(only_apis))] += 1
+    metrics.add_stage_time('ontology_parse', parse_seconds, items=num_rows)
+    write_start = time.perf_counter()
+    writer.close()
+    metrics.add_stage_time('write', write_seconds + time.perf_counter() - write_start, items=writer.count)
+    return {'tsv_file_path': tsv_file_path, 'save_path': writer.path, 'num_examples': writer.count, 'num_intents': num_intents,
+            'catalog': catalog, 'metrics': metrics.delta(metrics_before)}
+
+
+def merge_catalog(api_catalog, catalog):
+    """ Add a unit's partial catalog to `api_catalog` the way the serial loop did: an intent seen for the first
+    time gets an empty parameter list, its slots are only added from later sightings on.
+    """
+    for intent, (first_slots, later_slots) in catalog.items():
+        if intent not in api_catalog:
+            api_catalog[intent] = {
+                "description": "",
+                "parameters": []
+            }
+            new_slots = later_slots
+        else:
+            new_slots = first_slots + later_slots
+        for slot_name in new_slots:
+            if slot_name not in api_catalog[intent]["parameters"]:
+                api_catalog[intent]["parameters"].append(slot_name)
+
+
+def curate_seqtopv2(data_dir, save_dir, output_format='json', workers=1, force=False):
+    """ The (domain, split) units run in a pool of `workers` processes; their catalogs and stats are merged in the
+    serial order, so the outputs and the printed stats do not depend on `workers`.
+    Units whose TSV file, code and parameters did not change since the last run (see utils/manifest.py) are not
+    converted again, their stored catalog and stats are merged instead; `force` rebuilds everything.
+    """
     num_intents_total = {"1": 0, "2": 0, "3": 0, '4': 0, '5': 0}
     api_catalog = {}
     num_intents_train = {"1": 0, "2": 0, "3": 0, '4': 0, '5': 0}
     num_intents_eval = {"1": 0, "2": 0, "3": 0, '4': 0, '5': 0}
     num_intents_test = {"1": 0, "2": 0, "3": 0, '4': 0, '5': 0}
-    for domain in ['navigation', 'alarm', 'event', 'messaging', 'music', 'reminder', 'timer', 'weather']:
-        for split in ['train', 'eval', 'test']:
-            json_data = []
-            num_intents = {"1": 0, "2": 0, "3": 0, '4': 0, '5': 0}
-            tsv_file_path = os.path.join(data_dir, f'{domain}_{split}.tsv')
-            # Open and read the TSV file
-            with open(tsv_file_path, "r", newline="") as file:
-                # Create a CSV reader with tab as the delimiter
-                reader = csv.reader(file, delimiter="\t")
-
-                # Iterate through each row in the TSV file
-                for idx, row in enumerate(reader):
-                    if idx == 0:
-                        continue
-                    question = row[1]
-                    input_string = row[2]
-                    utterance_ontologies = get_ontologies(input_string)
-                    ontologies = {}
-                    ontologies = {
-                        key: list(
-                            set(
-                                ontologies.get(key, [])
-                                + utterance_ontologies.get(key, [])
-                            )
-                        )
-                        for key in (ontologies.keys() | utterance_ontologies.keys())
-                    }
-
-                    matches_2 = extract_slots(input_string)
-                    # Print the extracted slot information
-                    slot_info = {}
-                    for match in matches_2:
-                        parts = match.split(' ', maxsplit=1)
-                        slot_name = parts[0].replace('[', '').strip()
-                        slot_text = parts[1].replace(']', '').strip()
-                        if '[IN:' in slot_text:
-                            pattern_intent = r'\[IN:([^]][^\s]*)'
-                            matches_intent = re.findall(pattern_intent, slot_text)
-                            for in_match in matches_intent:
-                                slot_text = in_match
-                                break
-                        if slot_name in slot_info:
-                            slot_info[slot_name].append(slot_text)
-                        else:
-                            slot_info[slot_name] = [slot_text]
-                    apis_seq = []
-
-                    for intent, slots in ontologies.items():
-                        if 'UNSUPPORTED_' in intent:
-                            continue
-                        api_slots = {}
-                        for slot in slots:
-                            slt_val = slot_info['SL:' + slot][0]
-                            slot_info['SL:' + slot] = slot_info['SL:' + slot][1:]
-                            api_slots[slot] = slt_val
-                        api_slots_arr = [f'{slot} = "{val}"' for slot, val in api_slots.items()]
-                        api = f'{intent}({", ".join(api_slots_arr)})'
-                        apis_seq.append((api, input_string.index('IN:' + intent)))
-                        if intent not in api_catalog:
-                            api_catalog[intent] = {
-                                "description": "",
-                                "parameters": []
-                            }
-                        else:
-                            for slot_name, val in api_slots.items():
-                                if slot_name not in api_catalog[intent]["parameters"]:
-                                    api_catalog[intent]["parameters"].append(slot_name)
-
-                    # Use re.search to find the pattern in the input string
-                    if len(apis_seq) > 0:
-                        ordered_seq = sorted(apis_seq, key=lambda tup: tup[1], reverse=True)
-                        only_apis = []
-                        for api in ordered_seq:
-                            only_apis.append(api[0])
-                        json_data.append(
-                            {
-                                "input": question,
-                                'apis': only_apis,
-                            }
-                        )
-                        num_intents[str(len(only_apis))] += 1
-                        num_intents_total[str(len(only_apis))] += 1
-                save_path = os.path.join(save_dir, f"{domain}_{split}.json")
-                with open(save_path, 'w+') as file:
-                    json.dump(json_data, file, indent=4)
-
-                print(tsv_file_path)
-                print('Num of examples: ', len(json_data))
+    units = [(domain, split) for domain in DOMAINS for split in SPLITS]
+    manifest = BuildManifest(save_dir, force=force)
+    code = code_version(os.path.abspath(__file__), inspect.getsource(RecordWriter))
+    params = {'output_format': output_format}
+    inputs = {unit: manifest.input_hashes([os.path.join(data_dir, f'{unit[0]}_{unit[1]}.tsv')]) for unit in units}
+    stale = [unit for unit in units if not manifest.is_fresh(f'{unit[0]}_{unit[1]}', inputs[unit], code, params)]
+    print(f'{len(units) - len(stale)} of {len(units)} files are up to date')
+    process_unit = partial(curate_unit, data_dir=data_dir, save_dir=save_dir, output_format=output_format)
+    pool = Pool(min(workers, len(stale))) if workers > 1 and len(stale) > 1 else None
+    pending = {}
+    if pool is not None:
+        # start the largest files first so that the run takes about as long as the largest file
+        by_size = sorted(stale, key=lambda unit: os.path.getsize(os.path.join(data_dir, f'{unit[0]}_{unit[1]}.tsv')),
+                         reverse=True)
+        pending = {unit: pool.apply_async(process_unit, (unit,)) for unit in by_size}
+    try:
+        for unit in units:
+            domain, split = unit
+            if unit not in stale:
+                result = manifest.result(f'{domain}_{split}')
+            else:
+                result = pending[unit].get() if pool is not None else process_unit(unit)
+                if pool is not None:
+                    metrics.merge(result['metrics'])
+                stored = {key: val for key, val in result.items() if key != 'metrics'}
+                manifest.record(f'{domain}_{split}', inputs[unit], code, params, [result['save_path']], stored)
+            merge_catalog(api_catalog, result['catalog'])
+            num_intents = result['num_intents']
+            for key, val in num_intents.items():
+                num_intents_total[key] += val
+
+            print(result['tsv_file_path'])
+            print('Num of examples: ', result['num_examples'])
+            for key, val in num_intents.items():
+                print(f'\tNumber of examples with {key} APIs: {val}')
+            print('-' * 20)
+            if split == 'train':
+                for key, val in num_intents.items():
+                    num_intents_train[key] += val
+            elif split == 'eval':
+                for key, val in num_intents.items():
+                    num_intents_eval[key] += val
+            elif split == 'test':
                 for key, val in num_intents.items():
-                    print(f'\tNumber of examples with {key} APIs: {val}')
-                print('-' * 20)
-                if split == 'train':
-                    for key, val in num_intents.items():
-                        num_intents_train[key] += val
-                elif split == 'eval':
-                    for key, val in num_intents.items():
-                        num_intents_eval[key] += val
-                elif split == 'test':
-                    for key, val in num_intents.items():
-                        num_intents_test[key] += val
+                    num_intents_test[key] += val
+    finally:
+        if pool is not None:
+            pool.terminate()  # every result is in, or a unit failed and the others are not needed
+            pool.join()
     print('Overall stats: ')
     print(num_intents_total)
     for key, val in num_intents_total.items():
         print(f'Number of examples with {key} APIs: {val}')
-    with open(os.path.join(save_dir, 'api_spec.json'), 'w+') as file:
-        json.dump(api_catalog, file, indent=4)
+    with metrics.stage('write', items=len(api_catalog)):
+        with open(os.path.join(save_dir, 'api_spec.json'), 'w+') as file:
+            json.dump(api_catalog, file, indent=4)
 
     print('TRAIN:')
     num_train = 0
@@ -224,9 +248,16 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument("--data_dir", type=str)
     parser.add_argument("--save_dir", type=str)
+    parser.add_argument("--metrics_dir", type=str, default=None,
+                        help="where to write SeqTopV2-metrics.json/.prom on exit (default: --save_dir)")
+    parser.add_argument("--output_format", type=str, default='json', choices=sorted(OUTPUT_FORMATS),
+                        help="json array (as before), one record per line (optionally gzip-compressed) or a "
+                             "memory-mapped .records file with an offset index for random access")
+    parser.add_argument("--workers", type=int, default=1, help="processes converting (domain, split) files in parallel")
+    parser.add_argument("--force", action="store_true",
+                        help="rebuild every file, even those the build manifest marks as up to date")
     args = parser.parse_args()
+    metrics.write_on_exit(os.path.join(args.metrics_dir or args.save_dir, 'SeqTopV2-metrics'))
     os.makedirs(args.save_dir, exist_ok=True)
-    curate_seqtopv2(args.data_dir, args.save_dir)
-
-
-
+    curate_seqtopv2(args.data_dir, args.save_dir, output_format=args.output_format, workers=args.workers,
+                    force=args.force)
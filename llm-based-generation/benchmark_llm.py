@@ -0,0 +1,83 @@
+import argparse
+import importlib.util
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from benchmarks.synthetic import make_synthetic_dialogues
+from mock_genai_server import MockGENAIServer, add_server_arguments, server_kwargs
+from utils.metrics import percentile
+
+
+def load_llm_data_gen():
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'llm-data-gen.py')
+    spec = importlib.util.spec_from_file_location('llm_data_gen', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def serve(kwargs, port_queue):
+    server = MockGENAIServer(('127.0.0.1', 0), **kwargs)
+    port_queue.put(server.server_port)
+    server.serve_forever()
+
+
+def run_benchmark(args):
+    # the server runs in its own process so that it does not compete with the client for the GIL
+    port_queue = multiprocessing.Queue()
+    server_process = multiprocessing.Process(target=serve, args=(server_kwargs(args), port_queue), daemon=True)
+    server_process.start()
+    os.environ['GENAI_API'] = f'http://127.0.0.1:{port_queue.get()}'
+    os.environ.setdefault('GENAI_KEY', 'mock')
+    llm_data_gen = load_llm_data_gen()
+    try:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            data_dir = args.data_dir
+            if data_dir is None:
+                data_dir = os.path.join(tmp_dir, 'raw')
+                make_synthetic_dialogues(data_dir, args.num_files, args.dialogs_per_file, seed=args.seed or 0)
+            start = time.perf_counter()
+            stats = llm_data_gen.curate_llm_based_data(
+                data_dir, os.path.join(tmp_dir, 'processed'), 'benchmark', 'mock/model',
+                max_concurrency=args.max_concurrency, cache_path=None, rate_limit=args.rate_limit,
+                max_batch_size=args.max_batch_size, workers=args.workers)
+            elapsed = time.perf_counter() - start
+    finally:
+        server_process.terminate()
+    latencies = stats['latencies']
+    report = {
+        'wall_time_s': elapsed,
+        'prompts': stats['prompts'],
+        'requests': len(latencies),
+        'prompts_per_s': stats['prompts'] / elapsed if elapsed > 0 else 0.0,
+        'latency_p50_s': percentile(latencies, 50),
+        'latency_p95_s': percentile(latencies, 95),
+        'latency_p99_s': percentile(latencies, 99),
+        'retries': stats['retries'],
+    }
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark curate_llm_based_data against a local mock GENAI server')
+    parser.add_argument("--data_dir", type=str, default=None,
+                        help="raw SGD/MultiWOZ data, synthetic dialogues are generated when omitted")
+    parser.add_argument("--num_files", type=int, default=4, help="synthetic dialogue files per split")
+    parser.add_argument("--dialogs_per_file", type=int, default=50, help="synthetic dialogues per file")
+    parser.add_argument("--max_concurrency", type=int, default=8)
+    parser.add_argument("--rate_limit", type=float, default=None)
+    parser.add_argument("--max_batch_size", type=int, default=10)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--output", type=str, default=None, help="write the report to this JSON file")
+    add_server_arguments(parser)
+    args = parser.parse_args()
+    report = run_benchmark(args)
+    print(json.dumps(report, indent=4))
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=4)
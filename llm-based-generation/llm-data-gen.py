@@ -1,21 +1,56 @@
 import argparse
+import hashlib
+import inspect
 import json
 import jsonlines
 import os
-import time
+import sys
+from collections import namedtuple
+from multiprocessing import Pool
 
 import requests
+from requests.adapters import HTTPAdapter
 from dotenv import load_dotenv
 from tqdm import tqdm
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from request_scheduler import RequestScheduler
+from utils.io import OUTPUT_FORMATS, RecordWriter, imap_bounded
+from utils.kvstore import KeyValueStore
+from utils.manifest import BuildManifest, code_version
+from utils.metrics import metrics
 
-class GENAI:
-    def __init__(self, model) -> None:
+
+GENERATION_PARAMS = {'temperature': 0.7, 'max_new_tokens': 128, 'greedy': True}
+
+
+class LLMBackend:
+    """ Interface of the paraphrase generators: `ask_batch` returns one completion per prompt, in order. """
+    model = None
+
+    @property
+    def cache_id(self):
+        """ Model identifier used in the paraphrase cache keys. """
+        return self.model
+
+    def ask_batch(self, prompt, temperature=0.7, max_new_tokens=128, greedy=True):
+        raise NotImplementedError
+
+
+class GENAI(LLMBackend):
+    def __init__(self, model, max_concurrency=1, timeout=120) -> None:
         self.model = model
         env_path = "../.env"
         load_dotenv(env_path)
         self.API_KEY = os.getenv("GENAI_KEY", None)
         self.URL = os.getenv("GENAI_API", None)
+        self.timeout = timeout
+        # keep-alive session, sized so that every in-flight request gets its own pooled connection
+        self.max_concurrency = max(1, max_concurrency)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.max_concurrency)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
 
     def ask_batch(self, prompt, temperature=0.7, max_new_tokens=128, greedy=True):
         headers = {
@@ -32,133 +67,455 @@ class GENAI:
                 "decoding_method": decoding_method
             }
         }
-        response = requests.post(self.URL, headers=headers, data=json.dumps(data))
+        response = self.session.post(self.URL, headers=headers, data=json.dumps(data), timeout=self.timeout)
+        response.raise_for_status()
         output_list = [x['generated_text'] for x in response.json()['results']]
         return output_list
 
 
-def generate_llm_paraphrase(api_str_list, save_path, model):
-    def chunk_list(lst, chunk_size):
-        return [lst[i:i + chunk_size] for i in range(0, len(lst), chunk_size)]
+class LocalSeq2Seq(LLMBackend):
+    """ In-process, CPU-only seq2seq model (e.g. google/flan-t5-small) loaded once and reused across splits.
+    Prompts are sorted by token length and packed into batches of at most `max_batch_tokens` padded tokens.
+    """
+    chunk_size = 256  # prompts handed over per ask_batch call, i.e. per journaled batch
+
+    def __init__(self, model, max_batch_tokens=8192, num_threads=None) -> None:
+        try:
+            import torch
+            from transformers import AutoModelForSeq2SeqLM, AutoTokenizer
+        except ImportError as e:
+            raise ImportError('The local backend needs `pip install torch transformers sentencepiece`') from e
+        if num_threads:
+            torch.set_num_threads(num_threads)
+        self.torch = torch
+        self.model = model
+        self.max_batch_tokens = max_batch_tokens
+        self.tokenizer = AutoTokenizer.from_pretrained(model)
+        self.seq2seq = AutoModelForSeq2SeqLM.from_pretrained(model).to('cpu').eval()
+
+    @property
+    def cache_id(self):
+        return f'local:{self.model}'
+
+    def _generate(self, prompts, temperature, max_new_tokens, greedy):
+        inputs = self.tokenizer(prompts, return_tensors='pt', padding=True, truncation=True)
+        kwargs = {'max_new_tokens': max_new_tokens, 'do_sample': not greedy}
+        if not greedy:
+            kwargs['temperature'] = temperature
+        with self.torch.inference_mode():
+            generated = self.seq2seq.generate(**inputs, **kwargs)
+        return self.tokenizer.batch_decode(generated, skip_special_tokens=True)
+
+    def ask_batch(self, prompt, temperature=0.7, max_new_tokens=128, greedy=True):
+        lengths = [len(ids) for ids in self.tokenizer(prompt)['input_ids']]
+        order = sorted(range(len(prompt)), key=lambda i: lengths[i])
+        output_list = [None] * len(prompt)
+        batch = []
+        for pos, i in enumerate(order):
+            batch.append(i)
+            # prompts are sorted, so the next one sets the padded length of the grown batch
+            next_len = lengths[order[pos + 1]] if pos + 1 < len(order) else None
+            if next_len is None or next_len * (len(batch) + 1) > self.max_batch_tokens:
+                outputs = self._generate([prompt[j] for j in batch], temperature, max_new_tokens, greedy)
+                for j, txt in zip(batch, outputs):
+                    output_list[j] = txt
+                batch = []
+        return output_list
+
+
+class ParaphraseCache(KeyValueStore):
+    """ On-disk (SQLite) cache of LLM completions, shared across splits and runs.
+    Entries are keyed by a hash of the model id, the rendered prompt and the decoding parameters.
+    """
+    def __init__(self, db_path) -> None:
+        super().__init__(db_path, 'completions', 'text')
+        self.hits, self.misses = 0, 0
 
+    @staticmethod
+    def make_key(model, prompt, temperature, max_new_tokens, greedy):
+        decoding_method = 'greedy' if greedy else 'sample'
+        payload = json.dumps([model, prompt, temperature, max_new_tokens, decoding_method])
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def get_many(self, keys):
+        """ :return: dict of key -> cached completion for the keys present in the cache. """
+        keys = list(keys)
+        found = super().get_many(keys)
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        return found
+
+
+def load_journal(journal_path, repair=False):
+    """ Read the paraphrases recorded in an append-only journal.
+    Lines that are not valid JSON are skipped, and a partially written last line (e.g. after a crash) is ignored.
+    :param repair: truncate the journal after its last complete line, so that appending to it cannot extend a
+    torn line.
+    :return: dict of api -> paraphrase.
+    """
+    api_to_str = {}
+    if not os.path.exists(journal_path):
+        return api_to_str
+    complete_size = 0
+    with open(journal_path, 'rb') as fr:
+        for line in fr:
+            if not line.endswith(b'\n'):
+                break
+            complete_size += len(line)
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            api_to_str[entry['api']] = entry['text']
+    if repair and complete_size < os.path.getsize(journal_path):
+        os.truncate(journal_path, complete_size)
+    return api_to_str
+
+
+def append_journal(journal, apis, outputs):
+    for api, txt in zip(apis, outputs):
+        journal.write(json.dumps({'api': api, 'text': txt}) + '\n')
+    journal.flush()
+    os.fsync(journal.fileno())
+
+
+def build_prompt(api):
+    output_string = f'intent: {api}'
+    prompt = f'Convert the following intent and its parameteres into an imperative sentence. Do not copy the API or its parameters as is in the output sentence.\n\nInput:\n' + output_string + '\nOutput:\n'
+    return prompt
+
+
+def generate_llm_paraphrase(api_str_list, save_path, scheduler, cache=None, resume=False):
+    """ Paraphrase every API string with the LLM behind `scheduler`.
+    Each finished batch is appended to the JSONL journal at `save_path`; with `resume`, APIs already in the
+    journal are not requested again, otherwise the journal is started afresh.
+    """
     single_api_str_list = [api.split('[SEP]') for api in api_str_list]
     single_api_str_list = [item.strip() for sublist in single_api_str_list for item in sublist]  # flatten
-    genai_obj = GENAI(model=model)  # model can be any generative model
-    api_to_str = {}
-    chunked_list = chunk_list(single_api_str_list, 5)  # chucked api lists with batch size 5
-    for idx, batch in enumerate(chunked_list):
-        print(f'Processing batch {idx} out of {len(chunked_list)}')
-        prompts = []
-        for api in batch:
-            output_string = f'intent: {api}'
-            prompt = f'Convert the following intent and its parameteres into an imperative sentence. Do not copy the API or its parameters as is in the output sentence.\n\nInput:\n' + output_string + '\nOutput:\n'
-            prompts.append(prompt)
-        try:
-            outputs = genai_obj.ask_batch(prompts)
-        except:
-            print('Connection error at ask_batch')
-            time.sleep(5)
-            outputs = genai_obj.ask_batch(prompts)
-        for txt, api in zip(outputs, batch):
-            api_to_str[api] = txt
-        # uncomment to save llm phrases with interval of 100 batches
-        # if len(api_to_str) > 0 and len(api_to_str) % 100 == 0:
-        #     with open(save_path, 'w+') as file:
-        #         json.dump(api_to_str, file, indent=4)
-    # uncomment to save all llm phrases
-    # with open(save_path, 'w+') as file:
-    #     json.dump(api_to_str, file, indent=4)
+    unique_apis = list(dict.fromkeys(single_api_str_list))  # each distinct API string is paraphrased once
+    print(f'{len(single_api_str_list)} API strings, {len(unique_apis)} unique')
+    api_to_str = load_journal(save_path, repair=True) if resume else {}
+    if resume:
+        print(f'Resuming from {save_path}: {len(api_to_str)} paraphrases already journaled')
+    journal = open(save_path, 'a' if resume else 'w', encoding='utf8')
+
+    model = scheduler.client.cache_id
+    with metrics.stage('prompt_build', items=len(unique_apis)):
+        prompt_of = {api: build_prompt(api) for api in unique_apis}
+    key_of = {}
+    if cache is not None:
+        key_of = {api: ParaphraseCache.make_key(model, prompt_of[api], **GENERATION_PARAMS) for api in unique_apis}
+        lookup_apis = [api for api in unique_apis if api not in api_to_str]
+        cached = cache.get_many(key_of[api] for api in lookup_apis)
+        hit_apis = [api for api in lookup_apis if key_of[api] in cached]
+        hit_outputs = [cached[key_of[api]] for api in hit_apis]
+        api_to_str.update(zip(hit_apis, hit_outputs))
+        append_journal(journal, hit_apis, hit_outputs)  # the journal holds the split's full paraphrase table
+        print(f'Paraphrase cache: {len(hit_apis)} hits, {len(lookup_apis) - len(hit_apis)} misses')
+        metrics.count('cache_hits', len(hit_apis))
+        metrics.count('cache_misses', len(lookup_apis) - len(hit_apis))
+    pending_apis = [api for api in unique_apis if api not in api_to_str]
+
+    # batches are journaled as soon as they finish; if the scheduler gives up, what completed is kept
+    num_requests = len(scheduler.latencies)
+    try:
+        with metrics.stage('llm_call') as stage, tqdm(total=len(pending_apis)) as progress:
+            for idxs, outputs in scheduler.run([prompt_of[api] for api in pending_apis]):
+                batch = [pending_apis[i] for i in idxs]
+                for txt, api in zip(outputs, batch):
+                    api_to_str[api] = txt
+                append_journal(journal, batch, outputs)
+                if cache is not None:
+                    cache.put_many([(key_of[api], txt) for txt, api in zip(outputs, batch)])
+                progress.update(len(batch))
+                stage['items'] += len(batch)
+                metrics.count('prompts', len(batch))
+                # whitespace tokens, a tokenizer-independent approximation
+                metrics.count('prompt_tokens', sum(len(prompt_of[api].split()) for api in batch))
+                metrics.count('completion_tokens', sum(len(txt.split()) for txt in outputs))
+    except Exception:
+        print(f'LLM generation failed, completed batches are journaled in {save_path}; rerun with --resume')
+        raise
+    finally:
+        journal.close()
+        for latency in scheduler.latencies[num_requests:]:
+            metrics.observe('llm_request_latency_seconds', latency)
     return api_to_str
 
 
-def extract_raw_data(raw_data_dir):
-    data_files = [item for item in os.listdir(raw_data_dir) if
-                  os.path.isfile(os.path.join(raw_data_dir, item)) and not item == 'schema.json']
+def extract_dialog_file(file_path):
+    """ Extract the per-turn records of one dialogue file.
+    :param file_path: path of a SGD / MultiWOZ dialogue file.
+    :return: list of turn records with dialog_id, speaker, input and output (API string) keys.
+    """
+    with open(file_path, 'r', encoding='utf8') as fr:
+        data = json.load(fr)
     processed_data = []
-    for file in tqdm(data_files):
-        print(file)
-        data = json.load(open(os.path.join(raw_data_dir, file)))
-        print(len(data))
-        for d in tqdm(data):  # each dialog
-            for t in d['turns']:  # each turns
-                if t['speaker'] == 'USER':
-                    turn_intent_slots = []
-                    for f in t['frames']:
-                        if f['state']['slot_values'] and not f['state']['active_intent'] == 'NONE':
-                            turn_slots = []
-                            for slot, values in f['state']['slot_values'].items():
-                                turn_slots.append(f'{slot} = {values[0]}')
-                            slot_str = ' ; '.join(turn_slots)
-                            turn_intent_slots.append(f"{f['state']['active_intent']}({slot_str})")
-                    api_str = ' [SEP] '.join(turn_intent_slots)
-                    processed_data.append({
-                        'dialog_id': d['dialogue_id'],
-                        'speaker': 'USER',
-                        'input': t['utterance'],
-                        'output': api_str
-                    })
-                else:
-                    processed_data.append({
-                        'dialog_id': d['dialogue_id'],
-                        'speaker': 'BOT',
-                        'input': t['utterance'],
-                        'output': ''
-                    })
+    for d in data:  # each dialog
+        for t in d['turns']:  # each turns
+            if t['speaker'] == 'USER':
+                turn_intent_slots = []
+                for f in t['frames']:
+                    if f['state']['slot_values'] and not f['state']['active_intent'] == 'NONE':
+                        turn_slots = []
+                        for slot, values in f['state']['slot_values'].items():
+                            turn_slots.append(f'{slot} = {values[0]}')
+                        slot_str = ' ; '.join(turn_slots)
+                        turn_intent_slots.append(f"{f['state']['active_intent']}({slot_str})")
+                api_str = ' [SEP] '.join(turn_intent_slots)
+                processed_data.append({
+                    'dialog_id': d['dialogue_id'],
+                    'speaker': 'USER',
+                    'input': t['utterance'],
+                    'output': api_str
+                })
+            else:
+                processed_data.append({
+                    'dialog_id': d['dialogue_id'],
+                    'speaker': 'BOT',
+                    'input': t['utterance'],
+                    'output': ''
+                })
     return processed_data
 
 
-def curate_llm_based_data(data_dir_root, save_dir, dataset_name, model):
+def dialog_files(raw_data_dir):
+    """ :return: paths of the dialogue files in `raw_data_dir`, in directory order. """
+    data_files = [item for item in os.listdir(raw_data_dir) if
+                  os.path.isfile(os.path.join(raw_data_dir, item)) and not item == 'schema.json']
+    return [os.path.join(raw_data_dir, file) for file in data_files]
+
+
+def load_dialog_file(task):
+    """ Extract the turns of a dialogue file, or read them back from its extraction cache file if that is fresh.
+    :param task: (dialogue file path, extraction cache file path or None, whether the cache file is fresh).
+    """
+    file_path, cache_file, fresh = task
+    if fresh:
+        return list(iter_raw_file(cache_file))
+    records = extract_dialog_file(file_path)
+    if cache_file is not None:
+        with jsonlines.open(cache_file, "w") as writer:
+            writer.write_all(records)
+    return records
+
+
+def iter_raw_data(raw_data_dir, workers=1, manifest=None, extract_dir=None, pool=None):
+    """ Stream the turn records of every dialogue file in `raw_data_dir`, file by file in directory order.
+    With `workers` > 1 the files are parsed by a process pool (`pool`, or one of `workers` processes created for
+    the call); only a few files are held in memory at a time.
+    With a build `manifest`, the turns of each file are cached in `extract_dir` and a file is only parsed again
+    when its content or the extraction code changed.
+    """
+    file_paths = dialog_files(raw_data_dir)
+    tasks = [(file_path, None, False) for file_path in file_paths]
+    if manifest is not None:
+        os.makedirs(extract_dir, exist_ok=True)
+        code = code_version(inspect.getsource(extract_dialog_file))
+        manifest_dir = os.path.dirname(manifest.path)
+        tasks, inputs = [], {}
+        for file_path in file_paths:
+            cache_file = os.path.join(extract_dir, os.path.splitext(os.path.basename(file_path))[0] + '.jsonl')
+            inputs[file_path] = manifest.input_hashes([file_path])
+            fresh = manifest.is_fresh(os.path.relpath(cache_file, manifest_dir), inputs[file_path], code, {})
+            tasks.append((file_path, cache_file, fresh))
+        print(f'{sum(fresh for _, _, fresh in tasks)} of {len(tasks)} dialogue files are up to date')
+    own_pool = Pool(workers) if pool is None and workers > 1 else None
+    pool = pool or own_pool
+    results = map(load_dialog_file, tasks) if pool is None else imap_bounded(pool, load_dialog_file, tasks, 2 * workers)
+    try:
+        for (file_path, cache_file, fresh), records in tqdm(zip(tasks, results), total=len(tasks)):
+            if manifest is not None and not fresh:
+                manifest.record(os.path.relpath(cache_file, manifest_dir), inputs[file_path], code, {}, [cache_file])
+            yield from records
+    finally:
+        if own_pool is not None:
+            own_pool.terminate()
+
+
+def extract_raw_data(raw_data_dir, workers=1):
+    return list(iter_raw_data(raw_data_dir, workers=workers))
+
+
+def iter_raw_file(raw_save_path):
+    """ Stream the turn records saved with --save_raw. """
+    with jsonlines.open(raw_save_path, "r") as reader:
+        yield from reader
+
+
+def group_dialog_apis(raw_records, raw_writer=None):
+    """ Collect the API strings of the user turns, keeping only those in memory.
+    :return: list of API strings and dict of dialog_id -> API strings of its turns.
+    """
+    api_str_list, api_str_dialog_map = [], {}
+    for d in raw_records:
+        if d['output'] and 'NONE(' not in d['output']:
+            api_str_list.append(d['output'])
+            api_str_dialog_map.setdefault(d['dialog_id'], []).append(d['output'])
+        if raw_writer is not None:
+            raw_writer.write(d)
+    return api_str_list, api_str_dialog_map
+
+
+ParsedAPI = namedtuple('ParsedAPI', ['intent', 'slots'])
+
+
+def parse_api(api):
+    """ Split an `intent(slot = value ; ...)` string into its intent and list of `slot = value` strings.
+    Surrounding whitespace is kept in the intent, as the paraphrase table is keyed on the exact strings.
+    """
+    paren = api.index('(')
+    body = api[paren + 1:api.rindex(')')]
+    return ParsedAPI(api[:paren], body.split(' ; ') if body else [])
+
+
+def reconstruct_dialog(conv, api_to_str, parsed_apis):
+    """ Build the processed example of one dialog: for each intent (in order of first mention) take its longest
+    API string (the one with most slots) and use its paraphrase as input.
+    :param conv: API strings of the dialog's user turns.
+    :param parsed_apis: memo of api -> ParsedAPI shared across dialogs.
+    """
+    # per-dialog index: intent -> (length, position, api) of its longest API string, first one on ties
+    longest, position = {}, 0
+    for apis in conv:
+        for api in apis.split('[SEP]'):
+            if api not in parsed_apis:
+                parsed_apis[api] = parse_api(api)
+            intent = parsed_apis[api].intent
+            if intent not in longest or len(api) > longest[intent][0]:
+                longest[intent] = (len(api), -position, api)
+            position += 1
+    # an intent also matches the strings of intents it is a prefix of (e.g. FindRestaurant / FindRestaurants)
+    api_list = [max(entry for other, entry in longest.items() if other.startswith(intent))[2] for intent in longest]
+    input_list, output_list = [], []
+    for api in api_list:
+        if api in api_to_str:
+            output_list.append(api)
+            api_str = api_to_str[api].lower()
+            api_str = api_str + '.' if not api_str.endswith('.') else api_str
+            input_list.append(api_str)
+    if input_list and output_list:
+        return {
+            'input': ' '.join(input_list),
+            'output': ' [SEP] '.join(output_list)
+        }
+    return None
+
+
+def reconstruct_data(api_str_dialog_map, api_to_str):
+    """ Reconstruct the data with llm-paraphrases, one example per dialog. """
+    processed_data_dict_list, parsed_apis = [], {}
+    for _, conv in api_str_dialog_map.items():
+        example = reconstruct_dialog(conv, api_to_str, parsed_apis)
+        if example is not None:
+            processed_data_dict_list.append(example)
+    return processed_data_dict_list
+
+
+def write_processed(path_prefix, records, output_format='jsonl'):
+    """ Write the processed examples to `<path_prefix><extension of output_format>`. """
+    if output_format == 'jsonl':
+        with jsonlines.open(path_prefix + OUTPUT_FORMATS['jsonl'], "w") as writer:
+            writer.write_all(records)
+    else:
+        with RecordWriter(path_prefix, output_format) as writer:
+            writer.write_all(records)
+
+
+def make_backend(backend, model, max_concurrency=1, max_batch_tokens=8192, num_threads=None):
+    if backend == 'local':
+        return LocalSeq2Seq(model, max_batch_tokens=max_batch_tokens, num_threads=num_threads)
+    return GENAI(model=model, max_concurrency=max_concurrency)  # model can be any generative model
+
+
+def make_scheduler(llm, max_concurrency=1, rate_limit=None, max_batch_size=10, concurrency_limiter=None,
+                   bucket=None):
+    if isinstance(llm, LocalSeq2Seq):
+        # batching happens inside the backend
+        return RequestScheduler(llm, batch_size=llm.chunk_size, min_batch_size=llm.chunk_size,
+                                max_batch_size=llm.chunk_size, generation_params=GENERATION_PARAMS,
+                                concurrency_limiter=concurrency_limiter)
+    return RequestScheduler(llm, max_concurrency=max_concurrency, rate=rate_limit, max_batch_size=max_batch_size,
+                            generation_params=GENERATION_PARAMS, concurrency_limiter=concurrency_limiter,
+                            bucket=bucket)
+
+
+def curate_llm_based_data(data_dir_root, save_dir, dataset_name, model, max_concurrency=1, cache_path=None,
+                          resume=False, rate_limit=None, max_batch_size=10, workers=1, save_raw=False,
+                          reconstruct_only=False, backend='genai', max_batch_tokens=8192, num_threads=None,
+                          force=False, output_format='jsonl'):
+    """ Generate the Seq* data of each split: extract -> paraphrase -> reconstruct -> write.
+    With `reconstruct_only`, the turns saved by a previous --save_raw run and the paraphrase journals are
+    reused, so neither the raw dialogues nor the LLM are touched.
+    Otherwise a build manifest in `save_dir` (see utils/manifest.py) skips the splits whose dialogue files, code
+    and generation parameters did not change, and only re-parses the changed dialogue files of the others;
+    `force` rebuilds everything.
+    The processed examples are written as `<dataset_name>-processed-<split>` in `output_format` (see utils/io.py).
+    :return: LLM request stats (prompts, per-request latencies and retries per error class).
+    """
     os.makedirs(save_dir, exist_ok=True)
+    scheduler, cache, manifest = None, None, None
+    if not reconstruct_only:
+        # the model stays loaded for all splits
+        llm = make_backend(backend, model, max_concurrency=max_concurrency, max_batch_tokens=max_batch_tokens,
+                           num_threads=num_threads)
+        scheduler = make_scheduler(llm, max_concurrency=max_concurrency, rate_limit=rate_limit,
+                                   max_batch_size=max_batch_size)
+        cache = ParaphraseCache(cache_path) if cache_path else None
+        manifest = BuildManifest(save_dir, force=force)
+        code = code_version(os.path.abspath(__file__))
+        params = {'dataset_name': dataset_name, 'model': llm.cache_id, 'generation': GENERATION_PARAMS,
+                  'save_raw': save_raw, 'output_format': output_format}
     splits = ['train', 'test', 'dev']
     for split in splits:
         print(f'======= {split} =======')
-        data_dir = os.path.join(data_dir_root, split)
-        raw_data = extract_raw_data(data_dir)  # combine multiple dialog files
-
-        # uncomment to save intermediate data (raw data)
-        # raw_save_path = os.path.join(save_dir, f'{dataset_name}-raw-{split}.jsonl')
-        # with jsonlines.open(raw_save_path, "w") as writer:
-        #     writer.write_all(raw_data)
-
-        api_str_list, api_str_dialog_map = [], {}
-        for d in raw_data:
-            if d['output'] and 'NONE(' not in d['output']:
-                api_str_list.append(d['output'])
-                api_str_dialog_map.setdefault(d['dialog_id'], []).append(d['output'])
-
+        raw_save_path = os.path.join(save_dir, f'{dataset_name}-raw-{split}.jsonl')
         llm_paraphrase_save_path = os.path.join(save_dir, f'{dataset_name}-llm-{split}.jsonl')
-        api_to_str = generate_llm_paraphrase(api_str_list, llm_paraphrase_save_path, model)
-
-        # reconstruct the data with llm-paraphrases
-        processed_data_dict_list = []
-        for _, conv in api_str_dialog_map.items():
-            input_list, output_list, api_list, intents = [], [], [], []
-            for apis in conv:
-                api_list.extend(apis.split('[SEP]'))
-            for api in api_list:
-                intent = api[:api.index('(')]
-                if intent not in intents:
-                    intents.append(intent)
-            api_list = [max([api for api in api_list if api.startswith(intent)], key=len) for intent in
-                        intents]  # take the longest string of intents (more slots).
-            for api in api_list:
-                if api in api_to_str.keys():
-                    output_list.append(api)
-                    api_str = api_to_str[api].lower()
-                    api_str = api_str + '.' if not api_str.endswith('.') else api_str
-                    input_list.append(api_str)
-            if input_list and output_list:
-                processed_data_dict_list.append(
-                    {
-                        'input': ' '.join(input_list),
-                        'output': ' [SEP] '.join(output_list)
-                    }
-                )
+        processed_data_save_prefix = os.path.join(save_dir, f'{dataset_name}-processed-{split}')
+        processed_data_save_path = processed_data_save_prefix + OUTPUT_FORMATS[output_format]
+        if reconstruct_only:
+            with metrics.stage('extract'):
+                _, api_str_dialog_map = group_dialog_apis(iter_raw_file(raw_save_path))
+            api_to_str = load_journal(llm_paraphrase_save_path)
+        else:
+            data_dir = os.path.join(data_dir_root, split)
+            inputs = manifest.input_hashes(dialog_files(data_dir))
+            if manifest.is_fresh(os.path.basename(processed_data_save_path), inputs, code, params):
+                print('Up to date')
+                continue
+            # save intermediate data (raw data) while streaming it
+            raw_writer = jsonlines.open(raw_save_path, "w") if save_raw else None
+            extract_dir = os.path.join(save_dir, f'{dataset_name}-extract', split)
+            with metrics.stage('extract') as stage:
+                raw_records = iter_raw_data(data_dir, workers=workers, manifest=manifest, extract_dir=extract_dir)
+                api_str_list, api_str_dialog_map = group_dialog_apis(raw_records, raw_writer)
+                stage['items'] = len(api_str_list)
+            if raw_writer is not None:
+                raw_writer.close()
+            api_to_str = generate_llm_paraphrase(api_str_list, llm_paraphrase_save_path, scheduler,
+                                                 cache=cache, resume=resume)
+
+        with metrics.stage('reconstruct', items=len(api_str_dialog_map)):
+            processed_data_dict_list = reconstruct_data(api_str_dialog_map, api_to_str)
 
         # save processed outputs
-        processed_data_save_path = os.path.join(save_dir, f'{dataset_name}-processed-{split}.jsonl')
-        with jsonlines.open(processed_data_save_path, "w") as writer:
-            writer.write_all(processed_data_dict_list)
+        with metrics.stage('write', items=len(processed_data_dict_list)):
+            write_processed(processed_data_save_prefix, processed_data_dict_list, output_format)
+        if manifest is not None:
+            files = [processed_data_save_path, llm_paraphrase_save_path] + ([raw_save_path] if save_raw else [])
+            manifest.record(os.path.basename(processed_data_save_path), inputs, code, params, files,
+                            {'examples': len(processed_data_dict_list)})
+
+    stats = {'prompts': 0, 'latencies': [], 'retries': {}}
+    if scheduler is not None:
+        print(f'LLM requests: {len(scheduler.latencies)}, retries: {dict(scheduler.retries)}')
+        stats = {'prompts': scheduler.num_prompts, 'latencies': scheduler.latencies, 'retries': dict(scheduler.retries)}
+        for error_class, retries in scheduler.retries.items():
+            metrics.count(f'llm_retries_{error_class}', retries)
+    if cache is not None:
+        print(f'Paraphrase cache ({cache.db_path}): {cache.hits} hits, {cache.misses} misses')
+        cache.close()
+    return stats
 
 
 if __name__ == '__main__':
@@ -167,5 +524,40 @@ if __name__ == '__main__':
     parser.add_argument("--save_dir", type=str)
     parser.add_argument("--dataset_name", type=str)
     parser.add_argument("--model", type=str)
+    parser.add_argument("--backend", type=str, default='genai', choices=['genai', 'local'],
+                        help="genai: remote GENAI endpoint, local: in-process CPU seq2seq model given by --model")
+    parser.add_argument("--max_batch_tokens", type=int, default=8192,
+                        help="local backend: padded tokens per generation batch")
+    parser.add_argument("--num_threads", type=int, default=None, help="local backend: torch CPU threads")
+    parser.add_argument("--max_concurrency", type=int, default=1,
+                        help="maximum number of GENAI requests in flight (1 = sequential)")
+    parser.add_argument("--cache_path", type=str, default=None,
+                        help="SQLite paraphrase cache (default: <save_dir>/llm-cache.sqlite)")
+    parser.add_argument("--no_cache", action="store_true", help="do not read or write the paraphrase cache")
+    parser.add_argument("--rate_limit", type=float, default=None,
+                        help="maximum GENAI requests per second (token bucket), unlimited by default")
+    parser.add_argument("--max_batch_size", type=int, default=10,
+                        help="upper bound for the adaptive number of prompts per GENAI request")
+    parser.add_argument("--workers", type=int, default=1, help="processes used to parse the dialogue files")
+    parser.add_argument("--save_raw", action="store_true",
+                        help="also save the extracted turns to <dataset_name>-raw-<split>.jsonl")
+    parser.add_argument("--reconstruct_only", action="store_true",
+                        help="rebuild the processed files from the saved raw turns and paraphrase journals, "
+                             "without the LLM")
+    parser.add_argument("--resume", action="store_true",
+                        help="skip APIs already recorded in the <dataset_name>-llm-<split>.jsonl journals")
+    parser.add_argument("--metrics_dir", type=str, default=None,
+                        help="where to write <dataset_name>-metrics.json/.prom on exit (default: --save_dir)")
+    parser.add_argument("--force", action="store_true",
+                        help="rebuild every split and re-parse every dialogue file, ignoring the build manifest")
+    parser.add_argument("--output_format", type=str, default='jsonl', choices=['jsonl', 'jsonl.gz', 'records'],
+                        help="format of the processed files, records: memory-mapped file with an offset index")
     args = parser.parse_args()
-    curate_llm_based_data(args.data_dir, args.save_dir, args.dataset_name, args.model)
+    metrics.write_on_exit(os.path.join(args.metrics_dir or args.save_dir, f'{args.dataset_name}-metrics'))
+    cache_path = None if args.no_cache else (args.cache_path or os.path.join(args.save_dir, 'llm-cache.sqlite'))
+    curate_llm_based_data(args.data_dir, args.save_dir, args.dataset_name, args.model,
+                          max_concurrency=args.max_concurrency, cache_path=cache_path, resume=args.resume,
+                          rate_limit=args.rate_limit, max_batch_size=args.max_batch_size,
+                          workers=args.workers, save_raw=args.save_raw, reconstruct_only=args.reconstruct_only,
+                          backend=args.backend, max_batch_tokens=args.max_batch_tokens, num_threads=args.num_threads,
+                          force=args.force, output_format=args.output_format)
@@ -0,0 +1,151 @@
+import argparse
+import json
+import math
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class MockGENAIServer(ThreadingHTTPServer):
+    """ Local stand-in for the GENAI endpoint used by llm-data-gen.py.
+    Accepts {"model_id", "inputs", "parameters"} and answers {"results": [{"generated_text": ...}, ...]}, with
+    configurable latency, injected 5xx / 429 errors and a limit on concurrent requests (excess requests get 429).
+    """
+    daemon_threads = True
+
+    def __init__(self, address, latency='fixed', latency_mean=0.2, latency_std=0.1, per_prompt_latency=0.0,
+                 error_rate=0.0, rate_limit_rate=0.0, retry_after=1.0, max_concurrency=None, seed=None) -> None:
+        super().__init__(address, MockGENAIHandler)
+        self.latency = latency
+        self.latency_mean = latency_mean
+        self.latency_std = latency_std
+        self.per_prompt_latency = per_prompt_latency
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.max_concurrency = max_concurrency
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.stats = {'requests': 0, 'prompts': 0, 'errors': 0, 'rate_limited': 0}
+
+    def sample_latency(self, num_prompts):
+        with self.lock:
+            if self.latency == 'uniform':
+                delay = self.random.uniform(max(0.0, self.latency_mean - self.latency_std),
+                                            self.latency_mean + self.latency_std)
+            elif self.latency == 'lognormal' and self.latency_mean > 0:
+                # lognormal with the requested mean and standard deviation, gives a long tail of slow requests
+                sigma2 = math.log(1 + (self.latency_std / self.latency_mean) ** 2)
+                mu = math.log(self.latency_mean) - sigma2 / 2
+                delay = self.random.lognormvariate(mu, sigma2 ** 0.5)
+            else:
+                delay = self.latency_mean
+        return delay + self.per_prompt_latency * num_prompts
+
+    def draw_failure(self):
+        """ :return: 'rate_limit', 'error' or None for the next request. """
+        with self.lock:
+            self.stats['requests'] += 1
+            if self.max_concurrency is not None and self.in_flight >= self.max_concurrency:
+                self.stats['rate_limited'] += 1
+                return 'rate_limit'
+            r = self.random.random()
+            if r < self.rate_limit_rate:
+                self.stats['rate_limited'] += 1
+                return 'rate_limit'
+            if r < self.rate_limit_rate + self.error_rate:
+                self.stats['errors'] += 1
+                return 'error'
+            self.in_flight += 1
+            return None
+
+
+def mock_paraphrase(prompt):
+    """ Deterministic stand-in completion: turns `intent(slot = value ; ...)` into a short sentence. """
+    match = re.search(r'intent: (.*)\n', prompt)
+    api = match.group(1) if match else prompt
+    intent, _, slots = api.partition('(')
+    return f"Please {intent.strip()} with {slots.rstrip(')').replace(' ; ', ' and ')}".strip()
+
+
+class MockGENAIHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def _send(self, status, body, headers=None):
+        payload = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        for key, val in (headers or {}).items():
+            self.send_header(key, val)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_POST(self):
+        server = self.server
+        data = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+        prompts = data['inputs']
+        failure = server.draw_failure()
+        if failure == 'rate_limit':
+            return self._send(429, {'error': 'Too Many Requests'}, {'Retry-After': str(server.retry_after)})
+        if failure == 'error':
+            return self._send(503, {'error': 'Service Unavailable'})
+        try:
+            time.sleep(server.sample_latency(len(prompts)))
+            results = [{'generated_text': mock_paraphrase(prompt), 'input_text': prompt} for prompt in prompts]
+            with server.lock:
+                server.stats['prompts'] += len(prompts)
+            self._send(200, {'model_id': data.get('model_id'), 'results': results})
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+
+    def log_message(self, format, *args):
+        pass
+
+
+def add_server_arguments(parser):
+    parser.add_argument("--latency", type=str, default='fixed', choices=['fixed', 'uniform', 'lognormal'],
+                        help="latency distribution of a request")
+    parser.add_argument("--latency_mean", type=float, default=0.2, help="mean request latency in seconds")
+    parser.add_argument("--latency_std", type=float, default=0.1,
+                        help="spread of the request latency (half-width for uniform)")
+    parser.add_argument("--per_prompt_latency", type=float, default=0.0, help="extra seconds per prompt in a batch")
+    parser.add_argument("--error_rate", type=float, default=0.0, help="share of requests failing with 503")
+    parser.add_argument("--rate_limit_rate", type=float, default=0.0, help="share of requests rejected with 429")
+    parser.add_argument("--retry_after", type=float, default=1.0, help="Retry-After seconds sent with 429s")
+    parser.add_argument("--server_concurrency", type=int, default=None,
+                        help="requests served at once, more concurrent requests get 429")
+    parser.add_argument("--seed", type=int, default=None)
+
+
+def server_kwargs(args):
+    return {
+        'latency': args.latency,
+        'latency_mean': args.latency_mean,
+        'latency_std': args.latency_std,
+        'per_prompt_latency': args.per_prompt_latency,
+        'error_rate': args.error_rate,
+        'rate_limit_rate': args.rate_limit_rate,
+        'retry_after': args.retry_after,
+        'max_concurrency': args.server_concurrency,
+        'seed': args.seed,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", type=str, default='127.0.0.1')
+    parser.add_argument("--port", type=int, default=8080)
+    add_server_arguments(parser)
+    args = parser.parse_args()
+    server = MockGENAIServer((args.host, args.port), **server_kwargs(args))
+    print(f'Mock GENAI server listening on http://{args.host}:{server.server_port}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print(server.stats)
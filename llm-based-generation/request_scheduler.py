@@ -0,0 +1,219 @@
+import random
+import threading
+import time
+from collections import Counter, deque
+from contextlib import nullcontext
+from email.utils import parsedate_to_datetime
+from queue import Queue
+
+import requests
+
+# number of retries allowed per error class without any request succeeding in between
+DEFAULT_RETRY_BUDGETS = {
+    'rate_limit': 50,  # HTTP 429
+    'server': 10,  # HTTP 5xx
+    'connection': 10,  # connection errors and timeouts
+    'client': 0,  # other HTTP 4xx, retrying will not help
+    'other': 3,  # malformed responses
+}
+
+
+class RetryBudgetExhausted(Exception):
+    def __init__(self, error_class, error) -> None:
+        super().__init__(f'retry budget for {error_class} errors exhausted, last error: {error!r}')
+        self.error_class = error_class
+        self.error = error
+
+
+def classify_error(error):
+    if isinstance(error, requests.HTTPError) and error.response is not None:
+        status = error.response.status_code
+        if status == 429:
+            return 'rate_limit'
+        if status >= 500:
+            return 'server'
+        return 'client'
+    if isinstance(error, (requests.ConnectionError, requests.Timeout)):
+        return 'connection'
+    return 'other'
+
+
+def get_retry_after(error):
+    """ :return: delay in seconds requested by the server's Retry-After header, or None. """
+    response = getattr(error, 'response', None)
+    value = response.headers.get('Retry-After') if response is not None else None
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBucket:
+    """ Token-bucket limiter: on average `rate` requests per second, with bursts of up to `capacity`. """
+    def __init__(self, rate=None, capacity=None) -> None:
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate or 1.0)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def pause(self, seconds):
+        """ Hold back every caller for `seconds`, e.g. after the provider answered with 429. """
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    wait = self.paused_until - now
+                elif self.rate is None:
+                    return
+                else:
+                    self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class RequestScheduler:
+    """ Dispatches prompts to an LLM client with rate limiting, retries and adaptive batching.
+
+    - requests go through a token bucket (`rate` requests/sec, `burst` capacity, or a `bucket` shared with other
+      schedulers so that its rate and 429 pauses hold across all of them), at most `max_concurrency` in flight
+      (and, with a shared `concurrency_limiter` semaphore, at most its value across all schedulers using it);
+    - failed batches are retried with exponential backoff and full jitter, honouring Retry-After, until the
+      retry budget of their error class (see DEFAULT_RETRY_BUDGETS) is used up; budgets refill on every success;
+    - the batch size grows by one after fast, successful requests and is halved on errors or when a request takes
+      longer than `target_latency` seconds (AIMD), staying within [min_batch_size, max_batch_size].
+    """
+    def __init__(self, client, max_concurrency=1, rate=None, burst=None, batch_size=5, min_batch_size=1,
+                 max_batch_size=10, target_latency=20.0, base_backoff=1.0, max_backoff=60.0, retry_budgets=None,
+                 generation_params=None, concurrency_limiter=None, bucket=None) -> None:
+        self.client = client
+        # optional semaphore shared with other schedulers, bounding the requests in flight across all of them
+        self.concurrency_limiter = concurrency_limiter or nullcontext()
+        self.max_concurrency = max(1, max_concurrency)
+        self.bucket = bucket or TokenBucket(rate, burst)
+        self.min_batch_size = min_batch_size
+        self.max_batch_size = max(max_batch_size, min_batch_size)
+        self.batch_size = min(max(batch_size, self.min_batch_size), self.max_batch_size)
+        self.target_latency = target_latency
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.retry_budgets = dict(DEFAULT_RETRY_BUDGETS, **(retry_budgets or {}))
+        self.generation_params = generation_params or {}
+        self.error_rate = 0.0  # exponentially weighted share of failed requests
+        self.latencies = []  # seconds per successful request
+        self.num_prompts = 0  # prompts completed
+        self.retries = Counter()  # retries per error class
+        self.budget_used = Counter()  # retries per error class since the last successful request
+        self.lock = threading.Lock()
+
+    def _on_success(self, latency, num_prompts):
+        self.latencies.append(latency)
+        self.num_prompts += num_prompts
+        self.budget_used.clear()
+        self.error_rate *= 0.9
+        if latency > self.target_latency:
+            self.batch_size = max(self.min_batch_size, self.batch_size // 2)
+        elif self.error_rate < 0.05:
+            self.batch_size = min(self.max_batch_size, self.batch_size + 1)
+
+    def _on_error(self, error_class):
+        self.retries[error_class] += 1
+        self.budget_used[error_class] += 1
+        self.error_rate = 0.9 * self.error_rate + 0.1
+        self.batch_size = max(self.min_batch_size, self.batch_size // 2)
+
+    def _backoff(self, attempt, retry_after):
+        delay = random.uniform(0, min(self.max_backoff, self.base_backoff * 2 ** attempt))
+        if retry_after is not None:
+            delay = retry_after + random.uniform(0, min(self.base_backoff, retry_after))
+        return delay
+
+    def _ask(self, prompts):
+        outputs = self.client.ask_batch(prompts, **self.generation_params)
+        if len(outputs) != len(prompts):
+            raise ValueError(f'expected {len(prompts)} outputs, got {len(outputs)}')
+        return outputs
+
+    def run(self, prompts):
+        """ Generate completions for `prompts`.
+        :return: iterator of (prompt indices, outputs) pairs, one per successful request, in completion order.
+        If a retry budget runs out, batches already in flight are still yielded before the error is raised.
+        """
+        pending = deque(range(len(prompts)))
+        results = Queue()
+        stop = threading.Event()
+
+        def worker():
+            attempt = 0
+            while not stop.is_set():
+                with self.lock:
+                    if not pending:
+                        return
+                    idxs = [pending.popleft() for _ in range(min(self.batch_size, len(pending)))]
+                try:
+                    with self.concurrency_limiter:
+                        # take the rate token once a slot is free, so that waiting for a slot shared with other
+                        # schedulers cannot turn into a burst past the rate or a 429 pause
+                        self.bucket.acquire()
+                        start = time.monotonic()
+                        outputs = self._ask([prompts[i] for i in idxs])
+                    latency = time.monotonic() - start
+                except Exception as e:
+                    error_class = classify_error(e)
+                    with self.lock:
+                        pending.extendleft(reversed(idxs))
+                        self._on_error(error_class)
+                        exhausted = self.budget_used[error_class] > self.retry_budgets.get(error_class, 0)
+                    if exhausted:
+                        results.put((None, RetryBudgetExhausted(error_class, e)))
+                        stop.set()
+                        return
+                    retry_after = get_retry_after(e)
+                    delay = self._backoff(attempt, retry_after)
+                    attempt += 1
+                    print(f'{error_class} error at ask_batch ({e!r}), retrying in {delay:.1f}s')
+                    if error_class == 'rate_limit':
+                        self.bucket.pause(delay)
+                    stop.wait(delay)
+                    continue
+                attempt = 0
+                with self.lock:
+                    self._on_success(latency, len(idxs))
+                results.put((idxs, outputs))
+
+        threads = [threading.Thread(target=worker, daemon=True) for _ in range(self.max_concurrency)]
+        for thread in threads:
+            thread.start()
+        remaining = len(prompts)
+        try:
+            while remaining > 0:
+                idxs, outputs = results.get()
+                if idxs is None:
+                    error = outputs
+                    stop.set()
+                    for thread in threads:
+                        thread.join()
+                    while not results.empty():  # hand out batches that finished while stopping
+                        idxs, outputs = results.get()
+                        if idxs is not None:
+                            yield idxs, outputs
+                    raise error
+                remaining -= len(idxs)
+                yield idxs, outputs
+        finally:
+            stop.set()
@@ -0,0 +1,71 @@
+import importlib.util
+import os
+import random
+
+import pytest
+from nltk.chunk import conlltags2tree
+from nltk.tree import Tree
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'grammar-based-generation',
+                      'SeqSNIPS_SeqATIS-data-gen.py')
+
+
+def load_generator():
+    spec = importlib.util.spec_from_file_location('seq_snips_atis_data_gen', SCRIPT)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+generator = load_generator()
+
+
+def nltk_spans(tokens, tags):
+    """ Spans of the conlltags2tree reference; the POS tags are placeholders, the tree does not depend on them. """
+    tree = conlltags2tree([(token, 'NN', tag) for token, tag in zip(tokens, tags)])
+    return [(' '.join(token for token, _ in subtree.leaves()), subtree.label())
+            for subtree in tree if isinstance(subtree, Tree)]
+
+
+def random_sequence(rng, labels, max_len=12):
+    tags = [rng.choice(['O', 'B-', 'I-']) for _ in range(rng.randint(0, max_len))]
+    tags = [tag if tag == 'O' else tag + rng.choice(labels) for tag in tags]
+    return [f'w{i}' for i in range(len(tags))], tags
+
+
+def test_random_sequences_match_nltk():
+    rng = random.Random(0)
+    labels = ['city', 'date', 'airline_name', 'B', 'I-x']  # labels that look like tags too
+    token_seqs, tag_seqs = zip(*(random_sequence(rng, labels) for _ in range(30000)))
+    decoded = generator.decode_iob_batch(token_seqs, tag_seqs)
+    for tokens, tags, spans in zip(token_seqs, tag_seqs, decoded):
+        assert spans == nltk_spans(tokens, tags), list(zip(tokens, tags))
+
+
+@pytest.mark.parametrize('tags', [
+    ['I-city', 'I-city', 'O'],  # span opened by I- without B-
+    ['B-city', 'I-date', 'I-date'],  # I- of another label opens a new span
+    ['B-city', 'B-city', 'I-city'],  # adjacent spans of the same label
+    ['O', 'I-city', 'O', 'I-city'],  # I- after O opens a new span
+    ['B-city', 'O', 'O'],
+    [],
+])
+def test_edge_cases_match_nltk(tags):
+    tokens = [f'w{i}' for i in range(len(tags))]
+    assert generator.parse_IOB(tokens, tags) == nltk_spans(tokens, tags)
+
+
+@pytest.mark.parametrize('tags', [['B-city', 'X-city'], ['O', 'city'], ['b-city'], ['']])
+def test_malformed_tags_raise_like_nltk(tags):
+    tokens = [f'w{i}' for i in range(len(tags))]
+    with pytest.raises(ValueError):
+        nltk_spans(tokens, tags)
+    with pytest.raises(ValueError):
+        generator.parse_IOB(tokens, tags)
+
+
+def test_check_iob_equivalence_uses_no_tagger():
+    tokens, tags = ['fly', 'to', 'new', 'york'], ['O', 'O', 'B-city', 'I-city']
+    decoded = generator.decode_iob_batch([tokens], [tags])
+    assert decoded == [[('new york', 'city')]]
+    generator.check_iob_equivalence([tokens], [tags], decoded)
@@ -0,0 +1,44 @@
+import os
+import sys
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from utils.metrics import Metrics
+
+
+def test_nested_stages_remove_their_own_record():
+    metrics = Metrics()
+    outer, inner = metrics.stage('outer'), metrics.stage('inner')
+    outer_record = outer.__enter__()
+    inner.__enter__()  # an equal dict, started later
+    inner.__exit__(None, None, None)
+    assert len(metrics.active) == 1 and metrics.active[0] is outer_record
+    outer.__exit__(None, None, None)
+    assert metrics.active == []
+    assert metrics.stages['outer']['calls'] == metrics.stages['inner']['calls'] == 1
+
+
+def test_concurrent_stages():
+    metrics = Metrics()
+    barrier = threading.Barrier(8)
+    errors = []
+
+    def run(i):
+        try:
+            with metrics.stage('dag_convert'):
+                barrier.wait()
+                with metrics.stage('write', items=i % 2):
+                    barrier.wait()
+        except Exception as e:  # surfaced in the main thread
+            errors.append(e)
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    assert metrics.active == []
+    assert metrics.stages['dag_convert']['calls'] == metrics.stages['write']['calls'] == 8
+    assert metrics.stages['write']['items'] == 4
+    assert metrics.stages['write']['peak_rss_bytes'] > 0
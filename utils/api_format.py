@@ -0,0 +1,100 @@
+import ast
+import json
+import re
+
+# slot = "value" pairs of a SeqTopV2 API, e.g. GET_EVENT(LOCATION = "in paris", DATE_TIME = "tonight")
+QUOTED_SLOT = re.compile(r'\s*([^\s=,]+)\s*=\s*"(.*?)"\s*(?:,|$)', re.S)
+API_CALL = re.compile(r'\s*([^()]*?)\s*\((.*)\)\s*$', re.S)
+
+
+def normalize_text(text):
+    """ Lower-case `text` and collapse its whitespace. """
+    return ' '.join(str(text).lower().split())
+
+
+def normalize_value(value):
+    return normalize_text(value).strip('"\'')
+
+
+def parse_api_call(api):
+    """ Parse one API call of the SeqSGD/SeqMultiWOZ form `intent(slot = value ; ...)` or of the SeqTopV2 form
+    `INTENT(SLOT = "value", ...)`; a string without parentheses is an API without slots.
+    :return: (API name, list of (slot, value)).
+    """
+    match = API_CALL.match(api)
+    if match is None:
+        return api.strip(), []
+    name, body = match.groups()
+    if not body.strip():
+        return name, []
+    if QUOTED_SLOT.match(body):
+        return name, [(slot, value) for slot, value in QUOTED_SLOT.findall(body)]
+    slots = []
+    for item in body.split(';'):
+        slot, _, value = item.partition('=')
+        if slot.strip():
+            slots.append((slot.strip(), value.strip()))
+    return name, slots
+
+
+def parse_api_sequence(apis):
+    """ Parse an API sequence in any of the formats the generators write:
+    - a SeqSGD/SeqMultiWOZ `output` string, API calls joined by [SEP];
+    - a SeqTopV2 `apis` list of API call strings;
+    - a SeqATIS/SeqSNIPS `APIs` list of {'API', 'Parameters': {slot: [values]}} dicts;
+    - a JSON or Python literal (e.g. `str(record['APIs'])`) string of one of the lists above.
+    :return: list of (API name, list of (slot, value)), in sequence order.
+    """
+    if isinstance(apis, str):
+        stripped = apis.strip()
+        if stripped.startswith('[') and not stripped.startswith('[SEP]'):
+            try:
+                return parse_api_sequence(json.loads(stripped))
+            except ValueError:
+                pass
+            try:
+                return parse_api_sequence(ast.literal_eval(stripped))
+            except (ValueError, SyntaxError, MemoryError, RecursionError) as e:
+                raise ValueError(f'Cannot parse the API sequence {stripped[:200]!r}: it starts with [ but is '
+                                 f'neither JSON nor a Python literal') from e
+        return [parse_api_call(api) for api in stripped.split('[SEP]') if api.strip()]
+    parsed = []
+    for api in apis or []:
+        if isinstance(api, dict):
+            slots = []
+            for slot, values in (api.get('Parameters') or {}).items():
+                for value in values if isinstance(values, list) else [values]:
+                    slots.append((slot, value))
+            parsed.append((api['API'], slots))
+        else:
+            parsed.extend(parse_api_sequence(api))
+    return parsed
+
+
+def canonical_apis(apis):
+    """ Normalized form of a parsed API sequence, comparable across formats: API names and slot names are
+    lower-cased, values normalized, and each API's slots sorted and deduplicated.
+    :return: tuple of (API name, tuple of (slot, value)).
+    """
+    return tuple((normalize_text(name), tuple(sorted({(normalize_text(slot), normalize_value(value))
+                                                      for slot, value in slots})))
+                 for name, slots in apis)
+
+
+def canonical_string(canonical):
+    """ :return: the `canonical_apis` sequence as one `name(slot = value ; ...) [SEP] ...` string. """
+    return ' [SEP] '.join(f"{name}({' ; '.join(f'{slot} = {value}' for slot, value in slots)})"
+                          for name, slots in canonical)
+
+
+def record_input(record):
+    """ :return: the natural-language input of a generated record (`input`, or `text` for SeqATIS/SeqSNIPS). """
+    return record['input'] if 'input' in record else record['text']
+
+
+def record_apis(record):
+    """ :return: `canonical_apis` of the API sequence of a generated record of any Seq* dataset. """
+    for key in ('output', 'apis', 'APIs'):
+        if key in record:
+            return canonical_apis(parse_api_sequence(record[key]))
+    raise KeyError(f'Record has none of the output, apis or APIs keys: {sorted(record)}')
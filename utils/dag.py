@@ -0,0 +1,91 @@
+import time
+import traceback
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from functools import partial
+
+from utils.metrics import metrics
+
+
+def call_measured(func, args):
+    """ Run `func(*args)` (typically in a pool worker) and return its result with the metrics it recorded. """
+    before = metrics.snapshot()
+    result = func(*args)
+    return result, metrics.delta(before)
+
+
+def pool_starmap(pool, func, arg_tuples):
+    """ `pool.starmap` that also merges the metrics recorded in the worker processes into this process. """
+    results = []
+    for result, delta in pool.map(partial(call_measured, func), arg_tuples):
+        metrics.merge(delta)
+        results.append(result)
+    return results
+
+
+class Stage:
+    def __init__(self, name, func, deps) -> None:
+        self.name = name
+        self.func = func
+        self.deps = deps
+        self.kind = name.rsplit('/', 1)[-1]  # e.g. 'SeqSGD/train/extract' -> 'extract'
+
+
+class DAG:
+    """ Graph of named stages; a stage is called with the results of the stages it depends on, in order.
+    Stages must be added after their dependencies, so the graph cannot have cycles. Stage names are paths whose
+    last component is the stage kind (extract, paraphrase, segment, ...); wall time is recorded per kind.
+    """
+    def __init__(self) -> None:
+        self.stages = {}
+
+    def add(self, name, func, deps=()):
+        if name in self.stages:
+            raise ValueError(f'Duplicate stage {name!r}')
+        for dep in deps:
+            if dep not in self.stages:
+                raise ValueError(f'Stage {name!r} depends on unknown stage {dep!r}')
+        self.stages[name] = Stage(name, func, list(deps))
+        return name
+
+    def run(self, max_parallel=8):
+        """ Run every stage as soon as its dependencies finished, at most `max_parallel` at a time, in threads of
+        this process; CPU-heavy stages are expected to hand their work to a process pool.
+        On the first failure no new stage is started, the running ones are waited for and the error is raised.
+        :return: dict of stage name -> result.
+        """
+        results, running = {}, {}
+        waiting = list(self.stages.values())
+        failure = None
+        with ThreadPoolExecutor(max_workers=max_parallel) as executor:
+            while waiting or running:
+                if failure is None:
+                    ready = [stage for stage in waiting if all(dep in results for dep in stage.deps)]
+                    for stage in ready:
+                        waiting.remove(stage)
+                        args = [results[dep] for dep in stage.deps]
+                        running[executor.submit(self._run_stage, stage, args)] = stage
+                if not running:
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    stage = running.pop(future)
+                    try:
+                        results[stage.name] = future.result()
+                    except Exception as e:
+                        print(f'Stage {stage.name} failed:')
+                        traceback.print_exception(type(e), e, e.__traceback__)
+                        failure = failure or e
+        if failure is not None:
+            raise failure
+        return results
+
+    @staticmethod
+    def _run_stage(stage, args):
+        start = time.perf_counter()
+        print(f'[{stage.name}] started')
+        try:
+            with metrics.stage(f'dag_{stage.kind}'):
+                return stage.func(*args)
+        finally:
+            seconds = time.perf_counter() - start
+            print(f'[{stage.name}] finished in {seconds:.1f}s')
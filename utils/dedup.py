@@ -0,0 +1,316 @@
+import bisect
+import hashlib
+import os
+import re
+from array import array
+from collections import Counter, defaultdict
+from functools import partial
+from operator import eq
+from multiprocessing import Pool
+
+from rapidfuzz import fuzz
+
+from utils.api_format import canonical_string, normalize_text, record_apis, record_input
+from utils.io import OUTPUT_FORMATS, RecordWriter, chunked, format_of, imap_bounded, iter_records
+from utils.metrics import metrics
+
+SPLIT_ORDER = {'train': 0, 'dev': 1, 'eval': 1, 'test': 2}
+
+
+def shingle_hashes(text, apis, char_ngram=4):
+    """ Stable 64-bit hashes of the shingles of a record: the character n-grams of its input text, plus one
+    shingle per API and per API slot so that records with the same text but other APIs drift apart.
+    """
+    shingles = {text[i:i + char_ngram] for i in range(max(1, len(text) - char_ngram + 1))}
+    for name, slots in apis:
+        shingles.add(f'\0{name}')
+        shingles.update(f'\0{name}.{slot}={value}' for slot, value in slots)
+    return [int.from_bytes(hashlib.blake2b(shingle.encode('utf-8'), digest_size=8).digest(), 'little')
+            for shingle in shingles]
+
+
+class MinHashLSH:
+    """ One-permutation MinHash: every shingle hash falls into one of `num_perm` bins and a bin keeps the smallest
+    hash it got, so a signature costs one pass over the shingles. Empty bins borrow the value of the next non-empty
+    bin (rotation densification), which keeps signatures of short texts comparable.
+    The signature is cut into `bands` bands of `num_perm // bands` rows. Two records land in a common bucket of
+    some band with probability about 1 - (1 - J^rows)^bands for shingle Jaccard similarity J, so with the default
+    16 bands x 4 rows pairs above J ~ 0.5 are likely candidates. Signatures only depend on the shingle hashes, so
+    they can be computed in any process.
+    """
+    def __init__(self, num_perm=64, bands=16) -> None:
+        if num_perm % bands:
+            raise ValueError(f'num_perm ({num_perm}) must be a multiple of bands ({bands})')
+        self.num_perm, self.bands, self.rows = num_perm, bands, num_perm // bands
+
+    def signature(self, hashes):
+        bins = {}
+        for h in hashes:
+            bin_idx, value = h % self.num_perm, h // self.num_perm
+            if value < bins.get(bin_idx, value + 1):
+                bins[bin_idx] = value
+        signature = [bins.get(bin_idx) for bin_idx in range(self.num_perm)]
+        if len(bins) < self.num_perm:
+            for bin_idx in range(self.num_perm):
+                distance = 1
+                while signature[bin_idx] is None:
+                    borrowed = bins.get((bin_idx + distance) % self.num_perm)
+                    if borrowed is not None:
+                        signature[bin_idx] = (borrowed, distance)
+                    distance += 1
+        return signature
+
+    def band_keys(self, hashes):
+        """ :return: one bucket key per band of the MinHash signature of `hashes`. """
+        signature = self.signature(hashes)
+        return [hash(tuple(signature[band * self.rows:(band + 1) * self.rows])) for band in range(self.bands)]
+
+    def chunk_band_keys(self, chunk):
+        """ :param chunk: list of (normalized input text, canonical APIs).
+        :return: list of band keys of each record and the metrics recorded.
+        """
+        before = metrics.snapshot()
+        with metrics.stage('minhash', items=len(chunk)):
+            keys = [self.band_keys(shingle_hashes(text, apis)) for text, apis in chunk]
+        return keys, metrics.delta(before)
+
+
+def iter_bucket_chunks(band_keys, bands, texts, chunk_size=2000):
+    """ Group the records by their key in each band and yield the buckets of two or more records, in chunks of
+    about `chunk_size` bucket members.
+    :param band_keys: flat array of the `bands` band keys of each record.
+    :param texts: (global index, (normalized input, canonical API string)) of each record.
+    :return: generator of lists of (band, list of (global index, keys of the earlier bands, texts)).
+    """
+    num_records = len(band_keys) // bands
+    chunk, size = [], 0
+    for band in range(bands):
+        buckets = defaultdict(list)
+        for idx in range(num_records):
+            buckets[band_keys[idx * bands + band]].append(idx)
+        for members in buckets.values():
+            if len(members) < 2:
+                continue
+            chunk.append((band, [(texts[idx][0], tuple(band_keys[idx * bands:idx * bands + band]), texts[idx][1])
+                                 for idx in members]))
+            size += len(members)
+            if size >= chunk_size:
+                yield chunk
+                chunk, size = [], 0
+    if chunk:
+        yield chunk
+
+
+def score_buckets(buckets, threshold=90.0, api_threshold=90.0, max_bucket=100):
+    """ Score the candidate pairs of LSH buckets with rapidfuzz on their normalized inputs and canonical API
+    strings. A pair is only scored in the first band where its records share a bucket, and within a bucket each
+    record is paired with the `max_bucket` records before it, so that a large cluster of similar records cannot
+    make the candidates quadratic.
+    :param buckets: list of (band, list of (global index, keys of the earlier bands, (input, API string))).
+    :return: list of (i, j, input score, API score) of the pairs reaching both thresholds, the number of pairs
+    scored and the metrics recorded.
+    """
+    before = metrics.snapshot()
+    matches, num_pairs = [], 0
+    with metrics.stage('fuzzy_score') as stage:
+        for band, members in buckets:
+            for pos, (j, keys_j, (text_j, apis_j)) in enumerate(members):
+                for i, keys_i, (text_i, apis_i) in members[max(0, pos - max_bucket):pos]:
+                    if band and any(map(eq, keys_i, keys_j)):
+                        continue
+                    num_pairs += 1
+                    input_score = fuzz.ratio(text_i, text_j, score_cutoff=threshold)
+                    if not input_score:
+                        continue
+                    api_score = fuzz.ratio(apis_i, apis_j, score_cutoff=api_threshold) if api_threshold else 100.0
+                    if api_score:
+                        matches.append((i, j, input_score, api_score))
+        stage['items'] = num_pairs
+    return matches, num_pairs, metrics.delta(before)
+
+
+def find_near_duplicates(records, threshold=90.0, api_threshold=90.0, workers=1, pool=None, lsh=None,
+                         chunk_size=2000, max_bucket=100, rank=None):
+    """ Find the pairs of near-duplicate records in two steps: a MinHash LSH index over the input texts and API
+    sequences proposes candidate pairs, and only those are scored with rapidfuzz. Records whose normalized input
+    and APIs are identical are grouped first: each of them is paired with the first record of its group, only that
+    one is indexed, and its near-duplicates are reported for every member of the group.
+    The signatures, and the candidates of chunks of LSH buckets, are computed and scored in `pool`, or in a pool of
+    `workers` processes; this process only groups the records into buckets.
+    :param records: iterable of generated records of any Seq* dataset; only their normalized forms are kept.
+    :param threshold: minimal rapidfuzz ratio (0-100) of the normalized inputs.
+    :param api_threshold: minimal ratio of the canonical API strings, 0 to compare the inputs only.
+    :param rank: sort key of the record indices that orders the groups of identical records (default: file order).
+    :return: list of (i, j, input score, API score) with i < j, sorted.
+    """
+    lsh = lsh or MinHashLSH()
+    with metrics.stage('normalize') as stage:
+        normalized = [(normalize_text(record_input(record)), record_apis(record)) for record in records]
+        stage['items'] = len(normalized)
+    groups = {}
+    for idx, key in enumerate(normalized):
+        groups.setdefault(key, []).append(idx)
+    matches, unique, members = [], [], {}  # members: first record of a group -> the other records of the group
+    for group in groups.values():
+        first, *others = sorted(group, key=rank) if rank else group
+        unique.append(first)
+        if others:
+            members[first] = others
+            matches.extend((min(first, idx), max(first, idx), 100.0, 100.0) for idx in others)
+    unique.sort()
+    del groups
+    own_pool = Pool(workers) if pool is None and workers > 1 else None
+    pool = pool or own_pool
+    if pool is None:
+        imap = map
+    else:
+        imap = partial(imap_bounded, pool, window=2 * max(workers, 1))
+    try:
+        band_keys = array('q')
+        for keys, delta in imap(lsh.chunk_band_keys, chunked([normalized[idx] for idx in unique], chunk_size)):
+            if pool is not None:
+                metrics.merge(delta)
+            for record_keys in keys:
+                band_keys.extend(record_keys)
+        print(f'{len(normalized)} records, {len(unique)} distinct')
+        texts = [(idx, (normalized[idx][0], canonical_string(normalized[idx][1]))) for idx in unique]
+        del normalized
+        score = partial(score_buckets, threshold=threshold, api_threshold=api_threshold, max_bucket=max_bucket)
+        num_candidates = 0
+        for chunk_matches, num_pairs, delta in imap(score, iter_bucket_chunks(band_keys, lsh.bands, texts, chunk_size)):
+            if pool is not None:
+                metrics.merge(delta)
+            num_candidates += num_pairs
+            for i, j, input_score, api_score in chunk_matches:
+                for a in [i] + members.get(i, []):
+                    for b in [j] + members.get(j, []):
+                        matches.append((min(a, b), max(a, b), input_score, api_score))
+        print(f'{num_candidates} candidate pairs, {len(matches)} near-duplicates')
+    finally:
+        if own_pool is not None:
+            own_pool.close()
+            own_pool.join()
+    return sorted(matches)
+
+
+def records_to_drop(splits, matches):
+    """ Choose the records to drop so that no two kept records are near-duplicates: records are visited train
+    first, then dev/eval, then test, each in file order, and a record is dropped when it matches a kept one.
+    So duplicates within a split keep their first occurrence and leaked records are dropped from the
+    evaluation splits, never from train. Identical records (both scores 100) are decided together, as a group
+    represented by its first record.
+    :param splits: split name of each record.
+    :return: set of record indices.
+    """
+    def rank(idx):
+        return SPLIT_ORDER.get(splits[idx], len(SPLIT_ORDER)), idx
+
+    parent = {}
+
+    def find(idx):
+        while parent.get(idx, idx) != idx:
+            idx = parent[idx]
+        return idx
+
+    for i, j, input_score, api_score in matches:
+        if input_score == api_score == 100:
+            first, second = sorted((find(i), find(j)), key=rank)
+            if first != second:
+                parent[second] = first
+    members, neighbours = defaultdict(list), defaultdict(set)
+    for idx in {idx for match in matches for idx in match[:2]}:
+        members[find(idx)].append(idx)
+    for i, j, _, _ in matches:
+        first, second = find(i), find(j)
+        if first != second:
+            neighbours[first].add(second)
+            neighbours[second].add(first)
+    dropped, kept = set(), set()
+    for group in sorted(members, key=rank):
+        if neighbours[group] & kept:
+            dropped.update(members[group])
+        else:
+            kept.add(group)
+            dropped.update(idx for idx in members[group] if idx != group)
+    return dropped
+
+
+def split_of(path):
+    """ :return: the split named in an output file name, e.g. alarm_eval.json -> eval. """
+    splits = [token for token in re.split(r'[-_.]', os.path.basename(path)) if token in SPLIT_ORDER]
+    if not splits:
+        raise ValueError(f'Cannot tell the split of {path}, its name has none of {sorted(SPLIT_ORDER)}')
+    return splits[-1]
+
+
+def dedup_files(paths, threshold=90.0, api_threshold=90.0, workers=1, pool=None, lsh=None):
+    """ Find the near-duplicates within and across the splits of the output files of one dataset; the split of a
+    file is read from its name.
+    :return: (report dict, set of the global indices of the records to drop, see `records_to_drop`).
+    """
+    files, splits = [], []
+
+    def iter_all():
+        for path in paths:
+            split, count = split_of(path), 0
+            for record in iter_records(path):
+                count += 1
+                splits.append(split)
+                yield record
+            files.append({'path': path, 'split': split, 'records': count})
+
+    # identical records are paired with their first member in split order, so that leaks out of train are reported
+    matches = find_near_duplicates(iter_all(), threshold, api_threshold, workers=workers, pool=pool, lsh=lsh,
+                                   rank=lambda idx: (SPLIT_ORDER.get(splits[idx], len(SPLIT_ORDER)), idx))
+    starts, start = [], 0
+    for file in files:
+        starts.append(start)
+        start += file['records']
+
+    def locate(idx):
+        file_idx = bisect.bisect_right(starts, idx) - 1
+        return {'file': files[file_idx]['path'], 'index': idx - starts[file_idx]}
+
+    duplicates, leakage, leaked, pairs = Counter(), Counter(), defaultdict(set), []
+    for i, j, input_score, api_score in matches:
+        if splits[i] == splits[j]:
+            duplicates[splits[i]] += 1
+        else:
+            first, second = sorted((i, j), key=lambda idx: SPLIT_ORDER.get(splits[idx], len(SPLIT_ORDER)))
+            leakage[f'{splits[first]}-{splits[second]}'] += 1
+            leaked[splits[second]].add(second)
+        pairs.append({'a': locate(i), 'b': locate(j), 'input_score': input_score, 'api_score': api_score})
+    dropped = records_to_drop(splits, matches)
+    report = {
+        'threshold': threshold,
+        'api_threshold': api_threshold,
+        'files': files,
+        'records': dict(Counter(splits)),
+        'duplicate_pairs': dict(duplicates),
+        'leakage_pairs': dict(leakage),
+        'leaked_records': {split: len(indices) for split, indices in leaked.items()},
+        'dropped_records': dict(Counter(splits[idx] for idx in dropped)),
+        'pairs': pairs,
+    }
+    return report, dropped
+
+
+def write_deduplicated(files, dropped, output_dir):
+    """ Copy the files of a `dedup_files` report to `output_dir`, in their format, without the dropped records.
+    :return: list of the paths written.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    written, start = [], 0
+    for file in files:
+        path = file['path']
+        out_path = os.path.join(output_dir, os.path.basename(path))
+        if os.path.abspath(out_path) == os.path.abspath(path):
+            raise ValueError(f'Refusing to overwrite the input file {path}, choose another output directory')
+        fmt = format_of(path)
+        with RecordWriter(out_path[:-len(OUTPUT_FORMATS[fmt])], fmt) as writer:
+            for idx, record in enumerate(iter_records(path), start):
+                if idx not in dropped:
+                    writer.write(record)
+        start += file['records']
+        written.append(writer.path)
+    return written
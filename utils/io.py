@@ -0,0 +1,103 @@
+import gzip
+import json
+from collections import deque
+from itertools import islice
+
+from utils.recordfile import RecordFile, RecordFileWriter
+
+OUTPUT_FORMATS = {'json': '.json', 'jsonl': '.jsonl', 'jsonl.gz': '.jsonl.gz', 'records': '.records'}
+
+
+class RecordWriter:
+    """ Incrementally write records to `<path_prefix><extension of fmt>`.
+
+    - json: an indented JSON array, byte-identical to `json.dump(records, file, indent=4)`;
+    - jsonl / jsonl.gz: one JSON object per line, optionally gzip-compressed;
+    - records: a memory-mapped record file with an offset index, read back with `utils.recordfile.RecordFile`.
+    Records reach the file as they are written, nothing is buffered beyond the file object.
+    """
+    def __init__(self, path_prefix, fmt='json') -> None:
+        if fmt not in OUTPUT_FORMATS:
+            raise ValueError(f'Unknown output format {fmt!r}, expected one of {sorted(OUTPUT_FORMATS)}')
+        self.fmt = fmt
+        self.path = path_prefix + OUTPUT_FORMATS[fmt]
+        if fmt == 'records':
+            self.file = RecordFileWriter(self.path)
+        elif fmt == 'jsonl.gz':
+            self.file = gzip.open(self.path, 'wt', encoding='utf8')
+        else:
+            self.file = open(self.path, 'w')
+        self.count = 0
+
+    def write(self, record):
+        if self.fmt == 'json':
+            text = json.dumps(record, indent=4).replace('\n', '\n    ')
+            self.file.write(('[\n    ' if self.count == 0 else ',\n    ') + text)
+        elif self.fmt == 'records':
+            self.file.write(record)
+        else:
+            self.file.write(json.dumps(record) + '\n')
+        self.count += 1
+
+    def write_all(self, records):
+        for record in records:
+            self.write(record)
+
+    def close(self):
+        if self.fmt == 'json':
+            self.file.write('[]' if self.count == 0 else '\n]')
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def format_of(path):
+    """ :return: the output format of `path`, by its extension (see OUTPUT_FORMATS). """
+    for fmt, extension in sorted(OUTPUT_FORMATS.items(), key=lambda item: -len(item[1])):
+        if path.endswith(extension):
+            return fmt
+    raise ValueError(f'{path} has none of the extensions {sorted(OUTPUT_FORMATS.values())}')
+
+
+def iter_records(path):
+    """ Stream the records of a .json array, .jsonl, .jsonl.gz or .records file. """
+    if path.endswith('.records'):
+        with RecordFile(path) as records:
+            yield from records
+        return
+    if path.endswith('.json'):
+        with open(path, 'r', encoding='utf8') as fr:
+            yield from json.load(fr)
+        return
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rt', encoding='utf8') as fr:
+        for line in fr:
+            if line.strip():
+                yield json.loads(line)
+
+
+def chunked(iterable, size):
+    """ Yield lists of up to `size` consecutive items. """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def imap_bounded(pool, func, iterable, window):
+    """ Ordered `pool.imap` that only pulls `window` items ahead from `iterable`, so that a lazy input stream
+    is not read into memory faster than the results are consumed.
+    """
+    in_flight = deque()
+    for item in iterable:
+        in_flight.append(pool.apply_async(func, (item,)))
+        if len(in_flight) >= window:
+            yield in_flight.popleft().get()
+    while in_flight:
+        yield in_flight.popleft().get()
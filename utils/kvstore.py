@@ -0,0 +1,66 @@
+import sqlite3
+from collections import OrderedDict
+
+SQLITE_MAX_PARAMS = 500  # keys per SELECT, below SQLite's bound-parameter limit
+
+
+class KeyValueStore:
+    """ On-disk (SQLite) store of string keys and values, shared across splits, runs and worker processes, with an
+    optional in-memory LRU of the last `lru_size` decoded values in front of it.
+    Subclasses override `encode` / `decode` to store values other than strings.
+    """
+    def __init__(self, db_path, table, column, lru_size=0, timeout=60) -> None:
+        self.db_path = db_path
+        self.table, self.column = table, column
+        self.conn = sqlite3.connect(db_path, timeout=timeout)
+        self.conn.execute('PRAGMA journal_mode=WAL')  # worker processes read and write the same file
+        self.conn.execute(f'CREATE TABLE IF NOT EXISTS {table} (key TEXT PRIMARY KEY, {column} TEXT NOT NULL)')
+        self.conn.commit()
+        self.lru = OrderedDict()
+        self.lru_size = lru_size
+
+    @staticmethod
+    def encode(value):
+        return value
+
+    @staticmethod
+    def decode(text):
+        return text
+
+    def _remember(self, key, value):
+        if not self.lru_size:
+            return
+        self.lru[key] = value
+        self.lru.move_to_end(key)
+        if len(self.lru) > self.lru_size:
+            self.lru.popitem(last=False)
+
+    def get_many(self, keys):
+        """ :return: dict of key -> value for the keys present in the store. """
+        found, missing = {}, []
+        for key in keys:
+            if key in self.lru:
+                self.lru.move_to_end(key)
+                found[key] = self.lru[key]
+            else:
+                missing.append(key)
+        for i in range(0, len(missing), SQLITE_MAX_PARAMS):
+            chunk = missing[i:i + SQLITE_MAX_PARAMS]
+            rows = self.conn.execute(f'SELECT key, {self.column} FROM {self.table} '
+                                     f'WHERE key IN ({",".join("?" * len(chunk))})', chunk)
+            for key, text in rows:
+                found[key] = self.decode(text)
+                self._remember(key, found[key])
+        return found
+
+    def put_many(self, items):
+        """ :param items: iterable of (key, value). """
+        items = list(items)
+        for key, value in items:
+            self._remember(key, value)
+        self.conn.executemany(f'INSERT OR REPLACE INTO {self.table} (key, {self.column}) VALUES (?, ?)',
+                              [(key, self.encode(value)) for key, value in items])
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,88 @@
+import hashlib
+import json
+import os
+import threading
+
+MANIFEST_NAME = 'build-manifest.json'
+
+
+def file_hash(path):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def code_version(*sources):
+    """ Hash of the given source files and source strings (e.g. `inspect.getsource(func)`). """
+    sha = hashlib.sha256()
+    for source in sources:
+        if os.path.isfile(source):
+            with open(source, 'rb') as file:
+                sha.update(file.read())
+        else:
+            sha.update(source.encode('utf-8'))
+        sha.update(b'\0')
+    return sha.hexdigest()
+
+
+class BuildManifest:
+    """ Record of the outputs a generator produced in `save_dir`: for each output, the hashes of its input files,
+    the generator code version, its parameters, the files it wrote and an optional JSON result (e.g. statistics)
+    so that a later run can skip it when nothing it depends on changed.
+    Input files are only re-hashed when their size or modification time changed. A manifest may be shared by
+    threads building different outputs.
+    """
+    def __init__(self, save_dir, force=False) -> None:
+        self.path = os.path.join(save_dir, MANIFEST_NAME)
+        self.force = force
+        self.lock = threading.RLock()
+        self.entries, self.files = {}, {}
+        if os.path.exists(self.path):
+            with open(self.path, 'r', encoding='utf8') as file:
+                data = json.load(file)
+            self.entries, self.files = data.get('outputs', {}), data.get('files', {})
+
+    def input_hashes(self, paths):
+        """ :return: dict of path -> sha256 of its content. """
+        hashes = {}
+        for path in paths:
+            stat = os.stat(path)
+            with self.lock:
+                known = self.files.get(path)
+            if known is None or known['size'] != stat.st_size or known['mtime_ns'] != stat.st_mtime_ns:
+                known = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': file_hash(path)}
+                with self.lock:
+                    self.files[path] = known
+            hashes[path] = known['sha256']
+        return hashes
+
+    def is_fresh(self, output, inputs, code, params):
+        """ :param inputs: dict of input path -> hash, see `input_hashes`.
+        :return: whether `output` was built from the same inputs, code and parameters and its files still exist.
+        """
+        with self.lock:
+            entry = self.entries.get(output)
+        if self.force or entry is None:
+            return False
+        if entry['inputs'] != inputs or entry['code'] != code or entry['params'] != params:
+            return False
+        return all(os.path.exists(path) for path in entry['files'])
+
+    def result(self, output):
+        with self.lock:
+            return self.entries[output].get('result')
+
+    def record(self, output, inputs, code, params, files, result=None):
+        with self.lock:
+            self.entries[output] = {'inputs': inputs, 'code': code, 'params': params, 'files': list(files),
+                                    'result': result}
+            self.save()
+
+    def save(self):
+        with self.lock:
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w', encoding='utf8') as file:
+                json.dump({'outputs': self.entries, 'files': self.files}, file, indent=4)
+            os.replace(tmp_path, self.path)  # never leave a half-written manifest behind
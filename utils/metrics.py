@@ -0,0 +1,224 @@
+import atexit
+import copy
+import json
+import os
+import resource
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0]
+
+
+def peak_rss_bytes():
+    """ High-water mark of the resident set size of this process (since the last stage boundary where it is reset,
+    see `Metrics`) and of its finished child processes.
+    """
+    scale = 1 if sys.platform == 'darwin' else 1024  # ru_maxrss is in bytes on macOS, in KiB on Linux
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return max(own, children) * scale
+
+
+def _read_hwm_bytes():
+    """ VmHWM of this process: its peak resident set size since it started or since `_reset_hwm`. """
+    with open('/proc/self/status', 'rb') as file:
+        for line in file:
+            if line.startswith(b'VmHWM:'):
+                return int(line.split()[1]) * 1024  # reported in kB
+    raise OSError('VmHWM not found in /proc/self/status')
+
+
+def _reset_hwm():
+    """ Reset VmHWM (and ru_maxrss) of this process to its current resident set size (Linux 4.0+). """
+    with open('/proc/self/clear_refs', 'w') as file:
+        file.write('5')
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))]
+
+
+class Metrics:
+    """ Collects named stage timers, counters and histograms of one generator run.
+
+    Stages accumulate wall time, number of calls and processed items. The peak RSS of a stage is the largest
+    resident set size the process reached while one of its calls was running: on Linux, the kernel's high-water
+    mark is read and reset at every stage start and end, and credited to the stages running at that moment (stages
+    running in other threads of the process share it). Stages timed by hand with `add_stage_time` get the peak
+    since the previous stage boundary. Where the high-water mark cannot be reset, each stage falls back to the
+    process high-water mark at its end, which grows monotonically from stage to stage.
+    """
+    def __init__(self) -> None:
+        self.started = time.time()
+        self.stages = {}
+        self.counters = Counter()
+        self.histograms = {}
+        self.lock = threading.Lock()
+        self.active = []  # records of the stage calls that are running
+        self.process_peak = 0
+        self.hwm_resettable = None  # probed on the first checkpoint
+
+    def _rss_checkpoint(self):
+        """ Credit the peak RSS since the previous checkpoint to the running stages, then start a new interval.
+        Called with the lock held.
+        :return: the peak RSS of the interval.
+        """
+        if self.hwm_resettable is None:
+            try:
+                _read_hwm_bytes()
+                _reset_hwm()
+                self.hwm_resettable = True
+            except OSError:
+                self.hwm_resettable = False
+        if self.hwm_resettable:
+            rss = _read_hwm_bytes()
+            _reset_hwm()
+        else:
+            rss = peak_rss_bytes()
+        self.process_peak = max(self.process_peak, rss)
+        for record in self.active:
+            record['peak_rss_bytes'] = max(record['peak_rss_bytes'], rss)
+        return rss
+
+    @contextmanager
+    def stage(self, name, items=0):
+        """ Time a block; the caller may update the yielded dict's 'items' with the number of processed items. """
+        record = {'items': items, 'peak_rss_bytes': 0}
+        with self.lock:
+            self._rss_checkpoint()
+            self.active.append(record)
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            seconds = time.perf_counter() - start
+            with self.lock:
+                self._rss_checkpoint()
+                self.active = [active for active in self.active if active is not record]
+            self.add_stage_time(name, seconds, record['items'], peak_rss=record['peak_rss_bytes'])
+
+    def add_stage_time(self, name, seconds, items=0, calls=1, peak_rss=None):
+        """ Add one or more calls of a stage timed elsewhere; `peak_rss` defaults to the peak since the previous
+        stage boundary.
+        """
+        with self.lock:
+            rss = self._rss_checkpoint() if peak_rss is None else peak_rss
+            stage = self.stages.setdefault(name, {'seconds': 0.0, 'calls': 0, 'items': 0, 'peak_rss_bytes': 0})
+            stage['seconds'] += seconds
+            stage['calls'] += calls
+            stage['items'] += items
+            stage['peak_rss_bytes'] = max(stage['peak_rss_bytes'], rss)
+
+    def snapshot(self):
+        with self.lock:
+            return {'stages': copy.deepcopy(self.stages), 'counters': dict(self.counters)}
+
+    def delta(self, since):
+        """ Stage totals and counters accumulated after the `snapshot()` `since`, e.g. inside a worker process. """
+        now = self.snapshot()
+        stages = {}
+        for name, stage in now['stages'].items():
+            before = since['stages'].get(name, {'seconds': 0.0, 'calls': 0, 'items': 0})
+            if stage['calls'] > before['calls']:
+                stages[name] = {'seconds': stage['seconds'] - before['seconds'], 'calls': stage['calls'] - before['calls'],
+                                'items': stage['items'] - before['items'], 'peak_rss_bytes': stage['peak_rss_bytes']}
+        counters = {name: value - since['counters'].get(name, 0) for name, value in now['counters'].items()
+                    if value != since['counters'].get(name, 0)}
+        return {'stages': stages, 'counters': counters}
+
+    def merge(self, delta):
+        """ Add stage totals and counters collected elsewhere (see `delta`). """
+        for name, stage in delta['stages'].items():
+            self.add_stage_time(name, stage['seconds'], stage['items'], stage['calls'], stage['peak_rss_bytes'])
+        for name, value in delta['counters'].items():
+            self.count(name, value)
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] += value
+
+    def observe(self, name, value):
+        with self.lock:
+            self.histograms.setdefault(name, []).append(value)
+
+    def summary(self):
+        with self.lock:
+            stages = {}
+            for name, stage in self.stages.items():
+                stages[name] = dict(stage, items_per_second=stage['items'] / stage['seconds'] if stage['seconds'] else 0.0)
+            histograms = {}
+            for name, values in self.histograms.items():
+                histograms[name] = {
+                    'count': len(values),
+                    'sum': sum(values),
+                    'p50': percentile(values, 50),
+                    'p95': percentile(values, 95),
+                    'p99': percentile(values, 99),
+                    'buckets': {str(le): sum(1 for v in values if v <= le) for le in LATENCY_BUCKETS},
+                }
+            return {
+                'command': ' '.join(sys.argv),
+                'started': self.started,
+                'wall_seconds': time.time() - self.started,
+                'peak_rss_bytes': max(peak_rss_bytes(), self.process_peak),
+                'stages': stages,
+                'counters': dict(self.counters),
+                'histograms': histograms,
+            }
+
+    def to_openmetrics(self, summary=None):
+        summary = summary or self.summary()
+        lines = []
+
+        def family(name, kind, help_text, samples):
+            lines.append(f'# TYPE apiblend_{name} {kind}')
+            lines.append(f'# HELP apiblend_{name} {help_text}')
+            lines.extend(samples)
+
+        stages = summary['stages']
+        family('stage_seconds', 'counter', 'Wall time spent in a stage.',
+               [f'apiblend_stage_seconds_total{{stage="{n}"}} {s["seconds"]}' for n, s in stages.items()])
+        family('stage_calls', 'counter', 'Number of times a stage ran.',
+               [f'apiblend_stage_calls_total{{stage="{n}"}} {s["calls"]}' for n, s in stages.items()])
+        family('stage_items', 'counter', 'Items processed by a stage.',
+               [f'apiblend_stage_items_total{{stage="{n}"}} {s["items"]}' for n, s in stages.items()])
+        family('stage_items_per_second', 'gauge', 'Throughput of a stage.',
+               [f'apiblend_stage_items_per_second{{stage="{n}"}} {s["items_per_second"]}' for n, s in stages.items()])
+        family('stage_peak_rss_bytes', 'gauge', 'Peak resident set size while a stage ran.',
+               [f'apiblend_stage_peak_rss_bytes{{stage="{n}"}} {s["peak_rss_bytes"]}' for n, s in stages.items()])
+        for name, value in summary['counters'].items():
+            family(name, 'counter', f'Total {name.replace("_", " ")}.', [f'apiblend_{name}_total {value}'])
+        for name, hist in summary['histograms'].items():
+            samples = [f'apiblend_{name}_bucket{{le="{le}"}} {count}' for le, count in hist['buckets'].items()]
+            samples.append(f'apiblend_{name}_bucket{{le="+Inf"}} {hist["count"]}')
+            samples.append(f'apiblend_{name}_count {hist["count"]}')
+            samples.append(f'apiblend_{name}_sum {hist["sum"]}')
+            family(name, 'histogram', f'Distribution of {name.replace("_", " ")}.', samples)
+        family('wall_seconds', 'gauge', 'Wall time of the run.', [f'apiblend_wall_seconds {summary["wall_seconds"]}'])
+        family('peak_rss_bytes', 'gauge', 'Peak resident set size of the run.',
+               [f'apiblend_peak_rss_bytes {summary["peak_rss_bytes"]}'])
+        lines.append('# EOF')
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path_prefix):
+        """ Write <path_prefix>.json (summary) and <path_prefix>.prom (OpenMetrics text). """
+        directory = os.path.dirname(path_prefix)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        summary = self.summary()
+        with open(path_prefix + '.json', 'w') as file:
+            json.dump(summary, file, indent=4)
+        with open(path_prefix + '.prom', 'w') as file:
+            file.write(self.to_openmetrics(summary))
+
+    def write_on_exit(self, path_prefix):
+        atexit.register(self.write, path_prefix)
+
+
+metrics = Metrics()
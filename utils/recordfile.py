@@ -0,0 +1,150 @@
+import json
+import mmap
+import random
+import struct
+import sys
+from array import array
+
+MAGIC = b'APIBREC1'
+# magic, number of records, offset of the index
+HEADER = struct.Struct('<8sQQ')
+OFFSET = struct.Struct('<Q')
+
+
+class RecordFileWriter:
+    """ Write records to a memory-mappable record file:
+
+        header | record 0 | record 1 | ... | padding | index
+
+    Each record is compact UTF-8 JSON. The index holds count + 1 little-endian u64 offsets (the start of every record
+    and the end of the last one) and starts at a multiple of 8, so that it can be mapped as an array of offsets.
+    The header is written last; a file that was not closed has no index and is rejected by `RecordFile`.
+    """
+    def __init__(self, path) -> None:
+        self.path = path
+        self.file = open(path, 'wb')
+        self.file.write(HEADER.pack(MAGIC, 0, 0))
+        self.position = HEADER.size
+        self.offsets = array('Q')
+
+    def write(self, record):
+        data = json.dumps(record, separators=(',', ':')).encode('utf-8')
+        self.offsets.append(self.position)
+        self.file.write(data)
+        self.position += len(data)
+
+    def close(self):
+        count = len(self.offsets)
+        self.offsets.append(self.position)
+        padding = -self.position % OFFSET.size
+        self.file.write(b'\0' * padding)
+        index_offset = self.position + padding
+        if sys.byteorder != 'little':
+            self.offsets.byteswap()
+        self.file.write(self.offsets.tobytes())
+        self.file.seek(0)
+        self.file.write(HEADER.pack(MAGIC, count, index_offset))
+        self.file.close()
+
+
+class RecordFile:
+    """ Random-access reader of a record file (see `RecordFileWriter`).
+
+    The file is memory-mapped, so opening it is O(1) and only the pages of the records that are read become
+    resident; worker processes share those pages. `records[i]` decodes one record, `records.raw(i)` returns its
+    bytes without copying, and `records[a:b]` is a view on the same mapping, valid until the reader it came from
+    is closed. A reader can be pickled (e.g. to DataLoader workers); the copy maps the file again.
+    """
+    def __init__(self, path) -> None:
+        self.path = path
+        self.owner = True  # False for the views of `records[a:b]`, which do not own the mapping
+        with open(path, 'rb') as file:
+            self.mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, count, index_offset = HEADER.unpack_from(self.mmap, 0)
+        if magic != MAGIC:
+            raise ValueError(f'{path} is not a record file')
+        if index_offset == 0:
+            raise ValueError(f'{path} is incomplete, its writer was not closed')
+        self.index_offset = index_offset
+        self.index = None
+        if sys.byteorder == 'little':
+            self.index = memoryview(self.mmap)[index_offset:index_offset + OFFSET.size * (count + 1)].cast('Q')
+        self.start, self.stop = 0, count
+
+    def _offset(self, position):
+        if self.index is not None:
+            return self.index[position]
+        return OFFSET.unpack_from(self.mmap, self.index_offset + OFFSET.size * position)[0]
+
+    def _position(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('record index out of range')
+        return self.start + i
+
+    def _view(self, start, stop):
+        view = object.__new__(RecordFile)
+        view.__dict__.update(self.__dict__)
+        view.start, view.stop = start, stop
+        view.owner = False
+        return view
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def raw(self, i):
+        """ :return: memoryview of the JSON bytes of record `i`, pointing into the mapped file. """
+        position = self._position(i)
+        return memoryview(self.mmap)[self._offset(position):self._offset(position + 1)]
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start, stop, step = i.indices(len(self))
+            if step == 1:
+                return self._view(self.start + start, self.start + max(start, stop))
+            return [self[j] for j in range(start, stop, step)]
+        return json.loads(bytes(self.raw(i)))
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def iter_shard(self, shard_id=0, num_shards=1, shuffle=False, seed=0, epoch=0):
+        """ Iterate over the records of one of `num_shards` disjoint shards, e.g. one per training worker.
+        With `shuffle`, the records are first permuted with `seed` + `epoch`, the same way in every worker.
+        """
+        order = list(range(len(self)))
+        if shuffle:
+            random.Random(seed + epoch).shuffle(order)
+        for i in order[shard_id::num_shards]:
+            yield self[i]
+
+    def __getstate__(self):
+        return {'path': self.path, 'start': self.start, 'stop': self.stop}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'])
+        self.start, self.stop = state['start'], state['stop']
+
+    def close(self):
+        """ Unmap the file; its views must not be used anymore. Closing a view does nothing. If memoryviews from
+        `raw` are still alive, mmap cannot unmap the file (it raises BufferError); the file is then unmapped when the
+        last of them is released.
+        """
+        if not self.owner or self.mmap is None:
+            return
+        if self.index is not None:
+            self.index.release()
+            self.index = None
+        try:
+            self.mmap.close()
+        except BufferError:
+            pass  # the memoryviews keep the mmap object alive until they are garbage collected
+        self.mmap = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -0,0 +1,101 @@
+from collections import Counter
+from multiprocessing import Pool
+
+from utils.api_format import canonical_apis, parse_api_sequence
+from utils.io import chunked, imap_bounded
+
+GOLD_KEYS = ('output', 'apis', 'APIs')
+COUNT_FIELDS = ('examples', 'api_tp', 'api_gold', 'api_predicted', 'slot_tp', 'slot_gold', 'slot_predicted',
+                'api_sequence_match', 'exact_match')
+
+
+def record_sequence(record, key=None):
+    """ :return: the API sequence of a gold or predicted record: the value of `key` if given and present, else the
+    output / apis / APIs field that the generators write.
+    """
+    if key is not None and key in record:
+        return record[key]
+    for gold_key in GOLD_KEYS:
+        if gold_key in record:
+            return record[gold_key]
+    raise KeyError(f'Record has none of the keys {[key] if key else []} + {list(GOLD_KEYS)}: {sorted(record)}')
+
+
+def example_counts(gold, predicted):
+    """ Counts of one example, from its gold and predicted API sequences in any format `parse_api_sequence` reads.
+    APIs and (API, slot, value) triples are compared as multisets, the sequences in order.
+    :return: tuple of counts, in the order of COUNT_FIELDS.
+    """
+    gold, predicted = canonical_apis(parse_api_sequence(gold)), canonical_apis(parse_api_sequence(predicted))
+    gold_apis, predicted_apis = Counter(name for name, _ in gold), Counter(name for name, _ in predicted)
+    gold_slots = Counter((name, slot, value) for name, slots in gold for slot, value in slots)
+    predicted_slots = Counter((name, slot, value) for name, slots in predicted for slot, value in slots)
+    return (1, sum((gold_apis & predicted_apis).values()), len(gold), len(predicted),
+            sum((gold_slots & predicted_slots).values()), sum(gold_slots.values()), sum(predicted_slots.values()),
+            int([name for name, _ in gold] == [name for name, _ in predicted]), int(gold == predicted))
+
+
+def chunk_counts(pairs):
+    """ :param pairs: list of (gold, predicted) API sequences.
+    :return: dict of the summed `example_counts` of the chunk.
+    """
+    totals = [0] * len(COUNT_FIELDS)
+    for gold, predicted in pairs:
+        totals = [total + count for total, count in zip(totals, example_counts(gold, predicted))]
+    return dict(zip(COUNT_FIELDS, totals))
+
+
+def precision_recall_f1(tp, num_gold, num_predicted):
+    precision = tp / num_predicted if num_predicted else 0.0
+    recall = tp / num_gold if num_gold else 0.0
+    f1 = 2 * precision * recall / (precision + recall) if precision + recall else 0.0
+    return {'precision': precision, 'recall': recall, 'f1': f1}
+
+
+def summarize(counts):
+    """ :return: micro-averaged API and slot precision / recall / F1 and sequence accuracies of summed counts. """
+    examples = counts['examples']
+    return {
+        'examples': examples,
+        'api': precision_recall_f1(counts['api_tp'], counts['api_gold'], counts['api_predicted']),
+        'slot': precision_recall_f1(counts['slot_tp'], counts['slot_gold'], counts['slot_predicted']),
+        'api_sequence_accuracy': counts['api_sequence_match'] / examples if examples else 0.0,
+        'exact_match': counts['exact_match'] / examples if examples else 0.0,
+    }
+
+
+def score_pairs(pairs, workers=1, pool=None, chunk_size=5000):
+    """ Sum the `example_counts` of a stream of (gold, predicted) API sequences, each chunk of `chunk_size`
+    examples being parsed and counted in `pool` or in a pool of `workers` processes.
+    :return: Counter of summed counts; see `summarize`.
+    """
+    own_pool = Pool(workers) if pool is None and workers > 1 else None
+    pool = pool or own_pool
+    try:
+        if pool is None:
+            results = map(chunk_counts, chunked(pairs, chunk_size))
+        else:
+            results = imap_bounded(pool, chunk_counts, chunked(pairs, chunk_size), window=2 * max(workers, 1))
+        counts = Counter()
+        for chunk in results:
+            counts.update(chunk)
+    finally:
+        if own_pool is not None:
+            own_pool.close()
+            own_pool.join()
+    return counts
+
+
+def iter_pairs(gold_records, predicted_records, prediction_key=None):
+    """ Pair gold and predicted records by position.
+    :return: generator of (gold, predicted) API sequences.
+    """
+    sentinel = object()
+    gold_iter, predicted_iter = iter(gold_records), iter(predicted_records)
+    for position, gold in enumerate(gold_iter):
+        predicted = next(predicted_iter, sentinel)
+        if predicted is sentinel:
+            raise ValueError(f'Fewer predictions than gold examples ({position})')
+        yield record_sequence(gold), record_sequence(predicted, prediction_key)
+    if next(predicted_iter, sentinel) is not sentinel:
+        raise ValueError('More predictions than gold examples')